@@ -0,0 +1,105 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+
+"""Append-only archive of expired articles on local disk."""
+
+import os
+import zlib
+import struct
+import pickle
+
+SEGMENT_SIZE = 64 * 1024 * 1024
+HEADER = struct.Struct(">I")
+
+
+class Archive(object):
+    """Compressed articles appended to numbered segment files.
+
+    Each record is a length header followed by the compressed, pickled
+    article. Records are addressed by (segment, offset, length), which is
+    what append() returns and read() takes. Only one process should append
+    at a time, any number may read.
+    """
+
+    def __init__(self, directory, segment_size=SEGMENT_SIZE):
+        self.directory = directory
+        self.segment_size = segment_size
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+    def path_of(self, segment):
+        return os.path.join(self.directory, "segment-%06i.arc" % segment)
+
+    def segments(self):
+        return sorted(int(name[8:-4]) for name in os.listdir(self.directory)
+                      if name.startswith("segment-") and name.endswith(".arc"))
+
+    def __current(self):
+        segments = self.segments()
+        segment = segments[-1] if segments else 0
+        path = self.path_of(segment)
+        if os.path.exists(path) and os.path.getsize(path) >= self.segment_size:
+            segment += 1
+        return segment
+
+    def append(self, article):
+        """Append an article and return its location."""
+        return self.append_many([article])[0]
+
+    def append_many(self, articles):
+        """Append articles and return their locations.
+
+        The segments written to are synced once at the end, not after
+        every record.
+        """
+        locations = []
+        segment = self.__current()
+        f = open(self.path_of(segment), "ab")
+        try:
+            for article in articles:
+                record = zlib.compress(pickle.dumps(article,
+                                                    pickle.HIGHEST_PROTOCOL))
+                f.seek(0, os.SEEK_END)
+                if f.tell() >= self.segment_size:
+                    self.__sync(f)
+                    f.close()
+                    segment += 1
+                    f = open(self.path_of(segment), "ab")
+                    f.seek(0, os.SEEK_END)
+                offset = f.tell()
+                f.write(HEADER.pack(len(record)))
+                f.write(record)
+                locations.append((segment, offset, HEADER.size + len(record)))
+            self.__sync(f)
+        finally:
+            f.close()
+        return locations
+
+    @staticmethod
+    def __sync(f):
+        f.flush()
+        os.fsync(f.fileno())
+
+    def read(self, location):
+        """The article stored at a location returned by append()."""
+        segment, offset, length = location
+        with open(self.path_of(segment), "rb") as f:
+            f.seek(offset)
+            data = f.read(length)
+        return pickle.loads(zlib.decompress(data[HEADER.size:]))
+
+    def scan(self):
+        """Yield the location and article of every record, oldest first."""
+        for segment in self.segments():
+            with open(self.path_of(segment), "rb") as f:
+                while True:
+                    offset = f.tell()
+                    header = f.read(HEADER.size)
+                    if len(header) < HEADER.size:
+                        break
+                    size, = HEADER.unpack(header)
+                    record = f.read(size)
+                    if len(record) < size:
+                        break  # torn write at the end of the segment
+                    yield ((segment, offset, HEADER.size + size),
+                           pickle.loads(zlib.decompress(record)))
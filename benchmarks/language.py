@@ -0,0 +1,82 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+
+"""Compare the stoplist index of bot.LanguageGuesser with the old scan."""
+
+import os
+import sys
+import json
+import argparse
+import justext
+from time import time
+
+HERE = os.path.realpath(os.path.dirname(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+from bot import LanguageGuesser
+
+FIXTURES = os.path.join(HERE, "fixtures", "language")
+
+
+def scan_stoplists(html):
+    """guess_language as it was before the stoplist index."""
+    hits = dict()
+    htmlset = set(str(html).split(" "))
+    for lang in justext.get_stoplists():
+        hits[lang] = len(set(justext.get_stoplist(lang)).intersection(htmlset))
+    return max(hits, key=hits.get)
+
+
+def load_corpus(directory=FIXTURES):
+    corpus = []
+    for name in sorted(os.listdir(directory)):
+        if name.endswith(".html"):
+            with open(os.path.join(directory, name), "r") as f:
+                corpus.append((name[:-5], f.read()))
+    return corpus
+
+
+def measure(guess, corpus, rounds):
+    correct = 0
+    tstart = time()
+    for _ in range(rounds):
+        correct = sum([guess(html) == language for language, html in corpus])
+    elapsed = time() - tstart
+    return {"seconds_per_page": elapsed / (rounds * len(corpus)),
+            "accuracy": float(correct) / len(corpus)}
+
+
+def __main():
+    """Main"""
+    APP = argparse.ArgumentParser(description=__doc__)
+    APP.add_argument("--rounds", "-r", default=5, type=int,
+                     help="how often the corpus is guessed")
+    APP.add_argument("--json", "-j", default=False,
+                     help="print machine-readable results",
+                     action="store_const", const=True)
+    ARGS = APP.parse_args()
+
+    corpus = load_corpus()
+    tstart = time()
+    guesser = LanguageGuesser()
+    results = {"pages": len(corpus),
+               "index_seconds": time() - tstart,
+               "scan": measure(scan_stoplists, corpus, ARGS.rounds),
+               "index": measure(guesser.guess, corpus, ARGS.rounds)}
+    results["speedup"] = results["scan"]["seconds_per_page"] / \
+        results["index"]["seconds_per_page"]
+
+    if ARGS.json:
+        print json.dumps(results, indent=4, sort_keys=True)
+        return
+    print "%i pages, index built in %.3f sec" % (len(corpus),
+                                                results["index_seconds"])
+    for name in ["scan", "index"]:
+        print "%-6s %8.3f ms/page  %3i%% correct" % \
+            (name, 1000 * results[name]["seconds_per_page"],
+             100 * results[name]["accuracy"])
+    print "speedup %.1fx" % results["speedup"]
+
+
+if __name__ == "__main__":
+    __main()
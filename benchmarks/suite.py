@@ -0,0 +1,390 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+
+"""Measure curation and the web routes on a synthetic corpus.
+
+Feeds, pages and images are served by a local HTTP stand-in, and Redis is
+kept in memory by fakeredis unless --redis names a server. Its database is
+flushed, so never point it at the one you read news from.
+"""
+
+import os
+import sys
+import json
+import random
+import shutil
+import argparse
+import tempfile
+import threading
+from io import BytesIO
+from time import time, sleep
+from BaseHTTPServer import BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn, TCPServer
+
+from PIL import Image
+from redis import StrictRedis
+
+HERE = os.path.realpath(os.path.dirname(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+import bot
+from bot import Bot, Fetcher, WRITE_BATCH
+from storage import SQLiteRedis
+
+WORDS = ("news market city council storm flood river election vote party "
+         "minister school teacher hospital doctor patient energy price "
+         "bank rate inflation housing rent football club player season "
+         "league coach science study research climate summer winter road "
+         "traffic police court judge law tax budget company revenue cloud "
+         "software phone network station train airport flight tourist "
+         "museum festival music film actor theatre book author library "
+         "farmer harvest weather forecast village border trade export "
+         "import factory worker union strike").split()
+# made up words, so unrelated articles share as few words as real ones
+SYLLABLES = ["ka", "lo", "mi", "ne", "ru", "sa", "to", "vi", "ber", "dan",
+             "gor", "len", "mar", "pel", "ster", "win"]
+WORDS += sorted(set("".join(random.Random(number).sample(SYLLABLES, 3))
+                    for number in range(2000)))
+# keywords liked before the reading latencies are measured
+CLICKED_KEYWORDS = 40
+IMAGES = [(640, 480), (320, 240), (1024, 768), (100, 80), (800, 600)]
+
+
+class Corpus(object):
+    """Synthetic feeds, pages and images, the same for the same seed."""
+
+    def __init__(self, articles, feeds, seed=0):
+        self.articles = articles
+        self.feeds = feeds
+        self.seed = seed
+        self.images = [self.__jpeg(size) for size in IMAGES]
+
+    @staticmethod
+    def __jpeg(size):
+        data = BytesIO()
+        Image.new("RGB", size, (120, 60, 30)).save(data, "JPEG")
+        return data.getvalue()
+
+    def random(self, *key):
+        return random.Random("%s:%s" % (self.seed, ":".join(map(str, key))))
+
+    def words(self, rnd, number):
+        return " ".join(rnd.choice(WORDS) for _ in range(number))
+
+    def title(self, feed, number):
+        rnd = self.random("title", feed, number)
+        return "%s %i-%i" % (self.words(rnd, 6).capitalize(), feed, number)
+
+    def entries(self, feed):
+        return range(feed, self.articles, self.feeds)
+
+    def feed(self, host, feed):
+        """An RSS feed for even and an Atom feed for odd numbers."""
+        items = []
+        for number in self.entries(feed):
+            link = "%s/article/%i/%i.html" % (host, feed, number)
+            summary = self.words(self.random("summary", feed, number), 30)
+            if feed % 2:
+                items.append("<entry><title>%s</title><link href=\"%s\"/>"
+                             "<id>%s</id><summary>%s</summary></entry>" %
+                             (self.title(feed, number), link, link, summary))
+            else:
+                items.append("<item><title>%s</title><link>%s</link>"
+                             "<description>%s</description></item>" %
+                             (self.title(feed, number), link, summary))
+        if feed % 2:
+            return ("<?xml version=\"1.0\"?><feed xmlns="
+                    "\"http://www.w3.org/2005/Atom\"><title>Feed %i</title>"
+                    "%s</feed>" % (feed, "".join(items)))
+        return ("<?xml version=\"1.0\"?><rss version=\"2.0\"><channel>"
+                "<title>Feed %i</title>%s</channel></rss>" %
+                (feed, "".join(items)))
+
+    def page(self, host, feed, number):
+        rnd = self.random("page", feed, number)
+        paragraphs = "".join("<p>%s.</p>" % self.words(rnd, 40).capitalize()
+                             for _ in range(8))
+        return ("<html><head><title>%s</title></head><body>"
+                "<div class=\"nav\"><a href=\"/\">Home</a></div>"
+                "<h1>%s</h1><img src=\"%s/img/%i.jpg\" alt=\"\"/>%s"
+                "<div class=\"footer\">Copyright</div></body></html>" %
+                ((self.title(feed, number),) * 2 +
+                 (host, number % len(self.images), paragraphs)))
+
+    def article(self, number, release):
+        """A stored article as curation would leave it."""
+        feed = number % self.feeds
+        link = "http://bench.invalid/article/%i/%i.html" % (feed, number)
+        title = self.title(feed, number)
+        rnd = self.random("page", feed, number)
+        content = "\n\n".join(self.words(rnd, 40).capitalize() + "."
+                              for _ in range(8))
+        keywords = bot.find_keywords(title)
+        return {"id": bot.article_id(link),
+                "link": link,
+                "title": title,
+                "headline": bot.link_headline(title, keywords),
+                "release": release,
+                "content": content,
+                "rendered": (bot.RENDER_VERSION, bot.render_content(content)),
+                "media": "",
+                "image": "http://bench.invalid/img/%i.jpg" % (number % 5),
+                "keywords": keywords,
+                "read": False,
+                "feed": "http://bench.invalid/feed/%i.xml" % feed,
+                "sources": [],
+                }
+
+
+class Site(ThreadingMixIn, TCPServer):
+    """Local HTTP stand-in serving a corpus with a fixed latency."""
+
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, corpus, latency=0.0):
+        self.corpus = corpus
+        self.latency = latency
+        self.sent = 0
+        self.lock = threading.Lock()
+        TCPServer.__init__(self, ("127.0.0.1", 0), SiteHandler)
+        self.host = "http://127.0.0.1:%i" % self.server_address[1]
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def feeds(self):
+        return ["%s/feed/%i.xml" % (self.host, feed)
+                for feed in range(self.corpus.feeds)]
+
+
+class SiteHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        server = self.server
+        if server.latency:
+            sleep(server.latency)
+        parts = self.path.strip("/").split("/")
+        try:
+            if parts[0] == "feed":
+                body = server.corpus.feed(server.host, int(parts[1][:-4]))
+                ctype = "application/rss+xml"
+            elif parts[0] == "article":
+                body = server.corpus.page(server.host, int(parts[1]),
+                                          int(parts[2][:-5]))
+                ctype = "text/html; charset=utf-8"
+            elif parts[0] == "img":
+                body = server.corpus.images[int(parts[1][:-4])]
+                ctype = "image/jpeg"
+            else:
+                raise ValueError(self.path)
+        except (ValueError, IndexError):
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", ctype)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        with server.lock:
+            server.sent += len(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def connect(url=None):
+    if url:
+        return StrictRedis.from_url(url)
+    try:
+        from fakeredis import FakeStrictRedis
+    except ImportError:
+        sys.exit("Install fakeredis or pass --redis redis://host:port/db")
+    return FakeStrictRedis()
+
+
+def summarize(samples):
+    """Mean, median, 95th percentile and maximum of seconds, in ms."""
+    samples = sorted(samples)
+    if not samples:
+        return None
+    pick = lambda share: samples[min(len(samples) - 1,
+                                     int(share * len(samples)))]
+    return {"n": len(samples),
+            "mean_ms": 1000 * sum(samples) / len(samples),
+            "p50_ms": 1000 * pick(0.5),
+            "p95_ms": 1000 * pick(0.95),
+            "max_ms": 1000 * samples[-1]}
+
+
+def timed(function, *args, **kwargs):
+    tstart = time()
+    result = function(*args, **kwargs)
+    return time() - tstart, result
+
+
+def new_bot(directory, connection, **config):
+    connection.flushdb()
+    directory = tempfile.mkdtemp(dir=directory)
+    configfile = os.path.join(directory, "config")
+    config.setdefault("archive", os.path.join(directory, "archive"))
+    with open(configfile, "w") as f:
+        json.dump(config, f)
+    return Bot(configfile, connection)
+
+
+def bench_curate(site, connection, directory, samples):
+    """Throughput of a whole curation run and latency of its stages."""
+    b = new_bot(directory, connection, abos=site.feeds())
+    with b:
+        sent = site.sent
+        seconds, _ = timed(b.curate, verbose=False)
+        stored = len(b.database["articles"])
+        results = {"articles": stored,
+                   "feeds": site.corpus.feeds,
+                   "latency_ms": 1000 * site.latency,
+                   "seconds": seconds,
+                   "entries_per_second": stored / seconds,
+                   "bytes_per_second": (site.sent - sent) / seconds}
+
+    stages = dict((stage, []) for stage in
+                  ["fetch", "parse", "images", "store"])
+    fetcher = Fetcher()
+    corpus = site.corpus
+    articles = []
+    bot.parse_page(corpus.page(site.host, 0, 0))  # builds the stoplist index
+    for number in range(min(samples, corpus.articles)):
+        feed = number % corpus.feeds
+        link = "%s/article/%i/%i.html" % (site.host, feed, number)
+        seconds, page = timed(bot.get_html, link, fetcher)
+        stages["fetch"].append(seconds)
+        stages["parse"].append(timed(bot.parse_page, page)[0])
+        stages["images"].append(timed(bot.find_picture, page, fetcher)[0])
+        articles.append(corpus.article(number, time()))
+    b = new_bot(directory, connection)
+    with b:
+        for start in range(0, len(articles), WRITE_BATCH):
+            batch = articles[start:start + WRITE_BATCH]
+            seconds, _ = timed(b.store_articles, batch)
+            stages["store"].append(seconds / len(batch))
+    results["stages"] = dict((stage, summarize(times))
+                             for stage, times in stages.items())
+    return results
+
+
+def bench_reading(size, corpus, connection, directory, requests):
+    """Latency of hot_articles and the gallery, read and search routes."""
+    import web
+
+    b = new_bot(directory, connection)
+    now = time()
+    tstart = time()
+    with b:
+        batch = []
+        for number in range(size):
+            # spread over two days, so all are within the gallery's window
+            batch.append(corpus.article(number, now - number % 172800))
+            if len(batch) >= WRITE_BATCH:
+                b.store_articles(batch)
+                batch = []
+        b.store_articles(batch)
+        # a reader who clicked some keywords, so ranking has work to do
+        for word in random.Random(size).sample(WORDS, CLICKED_KEYWORDS):
+            b.like_keyword(word)
+    results = {"seed_seconds": time() - tstart}
+
+    web.BOT = b
+    client = web.FLASK_APP.test_client()
+    rnd = random.Random(size)
+    hot, window, gallery, read, search = [], [], [], [], []
+    for _ in range(requests):
+        with b:
+            hot.append(timed(b.hot_articles, 0, 12)[0])
+            window.append(timed(b.ranked_links, 0)[0])
+        gallery.append(timed(client.get, "/")[0])
+        number = rnd.randrange(size)
+        link = "http://bench.invalid/article/%i/%i.html" % (
+            number % corpus.feeds, number)
+        read.append(timed(client.get, "/read/%s" % bot.article_id(link))[0])
+        search.append(timed(client.get, "/search?q=%s+%s" % tuple(
+            rnd.sample(WORDS, 2)))[0])
+    results["hot_articles"] = summarize(hot)
+    results["ranked_links"] = summarize(window)
+    results["gallery"] = summarize(gallery)
+    results["read_article"] = summarize(read)
+    results["search"] = summarize(search)
+    return results
+
+
+def __main():
+    """Main"""
+    APP = argparse.ArgumentParser(description=__doc__)
+    APP.add_argument("--sizes", "-s", default="1000,10000,100000",
+                     help="comma separated numbers of stored articles")
+    APP.add_argument("--articles", "-a", default=1000, type=int,
+                     help="articles served for the curation run")
+    APP.add_argument("--feeds", "-f", default=20, type=int,
+                     help="feeds the articles are spread over")
+    APP.add_argument("--latency", "-l", default=0, type=float,
+                     help="milliseconds the site waits before answering")
+    APP.add_argument("--samples", default=100, type=int,
+                     help="pages timed stage by stage")
+    APP.add_argument("--requests", "-r", default=50, type=int,
+                     help="requests timed per route and size")
+    APP.add_argument("--seed", default=0, type=int)
+    APP.add_argument("--redis", default=None,
+                     help="url of a redis server to flush and use instead "
+                          "of fakeredis")
+    APP.add_argument("--sqlite", default=False,
+                     help="keep the database in a SQLite file instead",
+                     action="store_const", const=True)
+    APP.add_argument("--json", "-j", default=False,
+                     help="print machine-readable results",
+                     action="store_const", const=True)
+    ARGS = APP.parse_args()
+
+    corpus = Corpus(ARGS.articles, ARGS.feeds, ARGS.seed)
+    site = Site(corpus, ARGS.latency / 1000.0)
+    directory = tempfile.mkdtemp(prefix="anchorbot-bench-")
+    if ARGS.sqlite:
+        connection = SQLiteRedis(os.path.join(directory, "database.sqlite"))
+    else:
+        connection = connect(ARGS.redis)
+    try:
+        results = {"seed": ARGS.seed,
+                   "redis": "sqlite" if ARGS.sqlite else
+                            ARGS.redis or "fakeredis",
+                   "curate": bench_curate(site, connection, directory,
+                                          ARGS.samples),
+                   "sizes": {}}
+        for size in [int(size) for size in ARGS.sizes.split(",") if size]:
+            results["sizes"][str(size)] = bench_reading(
+                size, corpus, connection, directory, ARGS.requests)
+    finally:
+        shutil.rmtree(directory)
+        site.shutdown()
+
+    if ARGS.json:
+        print json.dumps(results, indent=4, sort_keys=True)
+        return
+    curate = results["curate"]
+    print "curate  %i articles of %i feeds in %.2f sec, %.1f entries/s, " \
+        "%.0f KB/s" % (curate["articles"], curate["feeds"], curate["seconds"],
+                       curate["entries_per_second"],
+                       curate["bytes_per_second"] / 1024)
+    for stage in ["fetch", "parse", "images", "store"]:
+        print "  %-6s %8.2f ms mean %8.2f ms p95" % \
+            (stage, curate["stages"][stage]["mean_ms"],
+             curate["stages"][stage]["p95_ms"])
+    for size, result in sorted(results["sizes"].items(),
+                               key=lambda item: int(item[0])):
+        print "%7s articles, stored in %.1f sec" % (size,
+                                                   result["seed_seconds"])
+        for name in ["hot_articles", "ranked_links", "gallery",
+                     "read_article", "search"]:
+            print "  %-12s %8.2f ms p50 %8.2f ms p95" % \
+                (name, result[name]["p50_ms"], result[name]["p95_ms"])
+
+
+if __name__ == "__main__":
+    __main()
@@ -5,22 +5,44 @@ import os
 import re
 import sys
 import json
+import zlib
 import atexit
+import random
+import hashlib
+import signal
+import argparse
+import sqlite3
+import resource
+import calendar
+from cgi import escape
 import pprint
 import justext
+import markdown
 import logging
 import requests
 import feedparser
-from PIL import Image
+from heapq import heappush, heappop
+from PIL import ImageFile
 from time import time, sleep
-#from Queue import Queue
+from Queue import Queue
 from socket import timeout
-from StringIO import StringIO
-#from threading import Thread
-from redis_collections import Dict, Set, Counter
+from urlparse import urlparse, urlsplit, parse_qsl
+from collections import OrderedDict, defaultdict
+from multiprocessing.pool import ThreadPool
+from threading import Thread, Lock, RLock, BoundedSemaphore, Event
+from redis import StrictRedis
+from archive import Archive
+from metrics import METRICS, summarize
+from scoring import HALF_LIFE, Scorer, decayed, forward
+from search import SearchIndex
+from storage import SQLiteRedis, copy_keys
+from redis_collections import (Dict, Counter, SortedSetCounter,
+                               RedisCollection)
 
 from Queue import Empty
-from multiprocess import JoinableQueue, Process, cpu_count, Queue, Pool
+from HTMLParser import HTMLParser
+from multiprocess import cpu_count, Pipe, Process
+from multiprocess.connection import Listener, Client, arbitrary_address
 from requests.packages.urllib3.exceptions import InsecureRequestWarning
 requests.packages.urllib3.disable_warnings()
 
@@ -29,244 +51,2070 @@ re_youtube = re.compile(r'((?<=watch\?v=)[-\w]+\
 
 re_images = re.compile(r'(?<=")[^"]+jpg(?=")', re.I)
 re_splitter = re.compile(r"[^\w@#]+", re.UNICODE)
+re_invisible = re.compile(r"<(script|style)[^>]*>.*?</\1\s*>|<!--.*?-->",
+                          re.I | re.S)
+re_tags = re.compile(r"<[^>]*>")
+re_tokens = re.compile(r"\S+", re.UNICODE)
+re_sentences = re.compile(r"[\(]?.+?[\.!\?][\)]?(?!\S)")
+re_paragraphs = re.compile(r"(?<=<p>)[^<]+(?=</p>)")
+re_blocks = re.compile(r"<(p|h[1-6])(?:\s[^>]*)?>(.*?)</\1\s*>", re.I | re.S)
+re_spaces = re.compile(r"\s+", re.UNICODE)
 
 HOME = os.path.join(os.path.expanduser("~"), ".config/anchorbot")
 HERE = os.path.realpath(os.path.dirname(__file__))
 CONFIGFILE = os.path.join(HOME, "config")
 NUM_THREADS = max(1, cpu_count() - 1)
 
+# image dimensions are read from at most this many leading bytes
+IMAGE_PROBE_LIMIT = 256 * 1024
+IMAGE_PROBE_CHUNK = 4096
+IMAGE_PROBES = 8
+
+# pages are read up to PAGE_LIMIT bytes and only if they are html
+PAGE_LIMIT = 2 * 1024 * 1024
+PAGE_CHUNK = 16 * 1024
+PAGE_TYPES = ("text/html", "application/xhtml+xml")
+SKIPPED_EXTENSIONS = (".pdf", ".mp3", ".mp4", ".m4a", ".ogg", ".webm", ".avi",
+                      ".mov", ".zip", ".gz", ".exe", ".dmg", ".iso",
+                      ".jpg", ".jpeg", ".png", ".gif")
+# seconds and bytes of memory each page may take to be parsed in a parser
+# process before the cheap extractor is used instead
+PARSE_SECONDS = 5
+PARSE_MEMORY = 256 * 1024 * 1024
+
+# failed page requests retried per run, and per page at most
+RETRY_BUDGET = 100
+RETRIES_PER_PAGE = 2
+
+# keyword link inside a headline, the article id is filled in when serving
+HEADLINE_LINK = '<a href="/read/%%(id)s/because/of/%s" target="_blank">%s</a>'
+
+# bump to render the content of stored articles again
+RENDER_VERSION = 1
+
+# stop guessing the language once the leader is this many stop words ahead
+LANGUAGE_MARGIN = 25
+LANGUAGE_CHECK_EVERY = 50
+
+# spread polls of feeds sharing a cycle by this fraction of the cycle
+POLL_JITTER = 0.1
+
+# relevance dominates the ranking score, release time only breaks ties
+RANK_TIEBREAK = 1e10
+# ranking scores grow forward from an epoch, which is moved up to now and
+# the scores scaled back once it lies this many seconds in the past
+RANK_REBASE = 4 * HALF_LIFE
+
+# query parameters that only track where a reader came from
+re_tracking = re.compile(r"^(utm_\w+|fbclid|gclid|mc_cid|mc_eid|ref|"
+                         r"source|cmpid|icid|ncid|ocid|_ga)$", re.I)
+# fingerprints are MINHASH_ROWS * MINHASH_BANDS minhashes of the words of an
+# entry; stories sharing all rows of a band are compared, and the same if at
+# least MINHASH_SIMILARITY of their minhashes agree
+MINHASH_ROWS = 4
+MINHASH_BANDS = 8
+MINHASH_SIMILARITY = 0.7
+MINHASH_MIN_WORDS = 8
+# similar entries are only one story if this share of the words of the
+# shorter headline appears in the other one as well
+TITLE_OVERLAP = 0.5
+MINHASH_PRIME = (1 << 61) - 1
+__salts = random.Random(MINHASH_PRIME)
+MINHASH_SALTS = [(__salts.randrange(1, MINHASH_PRIME),
+                  __salts.randrange(MINHASH_PRIME))
+                 for _ in range(MINHASH_ROWS * MINHASH_BANDS)]
+# new collections are stored under this prefix and their name, so processes
+# opening a fresh config at the same time agree on the keys
+KEY_PREFIX = "anchorbot:"
+INDEXES = ("ranking", "unread", "timeline", "keyword_index", "article_ids",
+           "feed_timelines", "fingerprints", "seen_links")
+# articles written to redis in one round trip
+WRITE_BATCH = 50
+
 class Config(dict):
     def __init__(self, configfile):
         dict.__init__(self)
-
-        self["redis_keys"] = {}
-        self["abos"] = []
         self.configfile = configfile
+        self.__stamp = None
+        self.__written = None
+
+        if not os.path.exists(os.path.dirname(configfile)):
+            os.makedirs(os.path.dirname(configfile))
+        self.load()
 
-        if not os.path.exists(HOME):
-            os.mkdir(HOME)
+    def __stat(self):
+        try:
+            stat = os.stat(self.configfile)
+        except OSError:
+            return None
+        return (stat.st_mtime, stat.st_size)
+
+    def load(self):
+        """Read the config file over the defaults.
+
+        The new values are gathered apart and swapped in, so threads
+        reading the config meanwhile never miss a key.
+        """
+        fresh = dict()
+        fresh["redis_keys"] = {}
+        fresh["abos"] = []
+        fresh["workers"] = 100
+        fresh["per_host"] = 4
+        fresh["queue_size"] = 200
+        fresh["page_limit"] = PAGE_LIMIT
+        fresh["retry_budget"] = RETRY_BUDGET
+        fresh["parsers"] = NUM_THREADS
+        fresh["parse_seconds"] = PARSE_SECONDS
+        fresh["parse_memory"] = PARSE_MEMORY
+        fresh["min_cycle"] = 300
+        fresh["max_cycle"] = 86400
+        # seconds to keep articles, read articles and articles per feed;
+        # expired articles are moved to the archive, 0 keeps them forever
+        fresh["retention"] = {"max_age": 30 * 86400,
+                              "read_max_age": 7 * 86400,
+                              "per_feed": 1000,
+                              "seen_max_age": 90 * 86400}
+        fresh["archive"] = os.path.join(os.path.dirname(self.configfile),
+                                        "archive")
+        # keep the collections in a "redis" server or in the "sqlite" file
+        fresh["storage"] = "redis"
+        fresh["sqlite"] = os.path.join(os.path.dirname(self.configfile),
+                                       "anchorbot.sqlite")
+        # full-text index of all stored and archived articles
+        fresh["search_index"] = os.path.join(os.path.dirname(self.configfile),
+                                             "search.sqlite")
+        # JSON summary of the last curation run, written when it finished
+        fresh["run_summary"] = os.path.join(os.path.dirname(self.configfile),
+                                            "last_run.json")
+
+        configfile = self.configfile
+        content = None
         if os.path.exists(configfile):
             if os.path.getsize(configfile) > 0:
                 with open(configfile, "r") as f:
                     content = json.load(f)
-                    self.update(content)
+                    fresh.update(content)
             else:
                 logging.warn("Empty config found. Creating new one. %s" % CONFIGFILE)
                 os.remove(configfile)
+        self.update(fresh)
+        for key in set(self) - set(fresh):
+            del self[key]
+        # what is in the file counts as written, so it is not written back
+        self.__written = None if content is None else self.__serialize()
+        self.__stamp = self.__stat()
+
+    def __serialize(self):
+        return json.dumps(dict(self), indent=4, sort_keys=True)
+
+    def reload(self):
+        """Load the config again if its file changed since last time."""
+        if self.__stat() == self.__stamp:
+            return False
+        self.load()
+        return True
 
     def save(self, database):
+        """Write the config, unless nothing changed since the last write."""
         for name, piece in database.items():
             self["redis_keys"][name] = piece.key
-        with open(self.configfile, "w") as f:
-            self["abos"] = list(set(self["abos"]))
-            json.dump(dict(self), f, indent=4)
+        self["abos"] = sorted(set(self["abos"]))
+        content = self.__serialize()
+        if content == self.__written:
+            return
+        # replace the file at once, other processes may be reading it
+        temporary = "%s.%i" % (self.configfile, os.getpid())
+        with open(temporary, "w") as f:
+            f.write(content)
+        os.rename(temporary, self.configfile)
+        self.__written = content
+        self.__stamp = self.__stat()
+
+
+class Fetcher(object):
+    """Shared HTTP session keeping connections alive and limiting each host.
+
+    Thread-safe, so one instance can serve all workers of a curation run.
+    """
+
+    def __init__(self, per_host=4, hosts=100, timeout=1.0,
+                 page_limit=PAGE_LIMIT, retries=RETRY_BUDGET):
+        self.per_host = per_host
+        self.timeout = timeout
+        self.page_limit = page_limit
+        self.retries = retries
+        self.session = requests.Session()
+        self.session.verify = False
+        adapter = requests.adapters.HTTPAdapter(pool_connections=hosts,
+                                                pool_maxsize=per_host)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.__slots = dict()
+        self.__lock = Lock()
+
+    def slot(self, url):
+        """Semaphore guarding the concurrent requests to the url's host."""
+        host = urlparse(url).netloc
+        with self.__lock:
+            if host not in self.__slots:
+                self.__slots[host] = BoundedSemaphore(self.per_host)
+            return self.__slots[host]
+
+    def get(self, url, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+        with self.slot(url):
+            return self.session.get(url, **kwargs)
+
+    def stream(self, url, read, **kwargs):
+        """Hand the streamed response to read, keeping its slot meanwhile."""
+        kwargs.setdefault("timeout", self.timeout)
+        with self.slot(url):
+            response = self.session.get(url, stream=True, **kwargs)
+            try:
+                return read(response)
+            finally:
+                response.close()
+
+    def retry(self):
+        """Take one retry from the budget of the run, False if it is spent."""
+        with self.__lock:
+            if self.retries <= 0:
+                return False
+            self.retries -= 1
+            return True
+
+    def page(self, url):
+        """Body of an html page, at most page_limit bytes of it.
+
+        Other content is refused by its headers before the body is read,
+        and "" is returned for it.
+        """
+        def read(response):
+            if not response:
+                return ""
+            host = urlparse(url).hostname
+            ctype = response.headers.get("Content-Type", "text/html")
+            if ctype.split(";")[0].strip().lower() not in PAGE_TYPES:
+                logging.debug("Refusing %s of %s", ctype, url)
+                METRICS.count("refused_pages", host=host)
+                return ""
+            chunks = []
+            size = 0
+            for chunk in response.iter_content(PAGE_CHUNK):
+                chunks.append(chunk)
+                size += len(chunk)
+                if size >= self.page_limit:
+                    logging.debug("Truncating %s at %i bytes", url, size)
+                    break
+            METRICS.count("fetched_bytes", size, kind="page", host=host)
+            return "".join(chunks)[:self.page_limit]
+
+        return self.stream(url, read)
+
+
+class Ranking(SortedSetCounter):
+    """Unread links by relevance, with keyword weights grown from an epoch.
+
+    Forward-decayed scores keep their order as time goes by, so the
+    ranking is only written when articles come and go or a keyword is
+    clicked.
+    """
+
+    def __init__(self, redis=None, key=None):
+        super(Ranking, self).__init__(redis=redis, key=key)
+        self.epoch_key = "%s:epoch" % self.key
+
+    def epoch(self):
+        """Time the scores are grown from, set to now when missing."""
+        epoch = self.redis.hget(self.epoch_key, "epoch")
+        if epoch is None:
+            self.redis.hsetnx(self.epoch_key, "epoch", repr(time()))
+            epoch = self.redis.hget(self.epoch_key, "epoch")
+        return float(epoch)
+
+    def set_epoch(self, epoch, pipe=None):
+        pipe = self.redis if pipe is None else pipe
+        pipe.hset(self.epoch_key, "epoch", repr(float(epoch)))
+
+    def increment_score(self, member, amount=1, pipe=None):
+        pipe = self.redis if pipe is None else pipe
+        return pipe.zincrby(self.key, self._pickle(member), float(amount))
+
+    def clear(self, pipe=None):
+        pipe = self.redis if pipe is None else pipe
+        pipe.delete(self.epoch_key)
+        super(Ranking, self).clear(pipe=pipe)
+
+
+class KeywordClicks(Counter):
+    """Counter of keyword clicks whose writes can join a transaction."""
+
+    def set_count(self, keyword, count, pipe=None):
+        pipe = self.redis if pipe is None else pipe
+        pipe.hset(self.key, self._pickle_key(keyword),
+                  self._pickle_value(count))
+
+
+class KeywordWeights(Dict):
+    """Decayed click weight of each keyword and the time it was last set."""
+
+    def set_weight(self, keyword, weight, stamp, pipe=None):
+        pipe = self.redis if pipe is None else pipe
+        pipe.hset(self.key, self._pickle_key(keyword),
+                  self._pickle_value((weight, stamp)))
+
+
+class Links(Dict):
+    """Dict of links whose writes can join a transaction."""
+
+    def set(self, key, link, pipe=None):
+        pipe = self.redis if pipe is None else pipe
+        pipe.hset(self.key, self._pickle_key(key), self._pickle_value(link))
+
+
+class SeenLinks(RedisCollection):
+    """Short digests of the canonical links already fetched, by time.
+
+    Links of stored, archived and failed articles are all remembered, so
+    feeds are checked against one structure in one round trip.
+    """
+
+    def __init__(self, redis=None, key=None):
+        super(SeenLinks, self).__init__(redis=redis, key=key)
+
+    @staticmethod
+    def digest(link):
+        return hashlib.sha1(canonical_link(link).encode("utf-8")).digest()[:8]
+
+    def add(self, links, when=None, pipe=None):
+        pipe = self.redis if pipe is None else pipe
+        when = when or time()
+        for link in links:
+            pipe.zadd(self.key, when, self.digest(link))
+
+    def seen(self, links):
+        """Whether each of the links was seen, in one round trip."""
+        with self.redis.pipeline(transaction=False) as pipe:
+            for link in links:
+                pipe.zscore(self.key, self.digest(link))
+            return [score is not None for score in pipe.execute()]
+
+    def forget(self, before, pipe=None):
+        pipe = self.redis if pipe is None else pipe
+        return pipe.zremrangebyscore(self.key, "-inf", before)
+
+    def __len__(self, pipe=None):
+        pipe = self.redis if pipe is None else pipe
+        return pipe.zcard(self.key)
+
+    def clear(self, pipe=None):
+        pipe = self.redis if pipe is None else pipe
+        self._clear(pipe)
+
+    def _data(self, pipe=None):
+        pipe = self.redis if pipe is None else pipe
+        return pipe.zrange(self.key, 0, -1, withscores=True)
+
+    def _repr_data(self):
+        return "<%i links>" % len(self)
+
+
+class KeywordIndex(RedisCollection):
+    """Maps keywords to the set of unread links whose headline contains them.
+
+    Links are pickled like the members of a SortedSetCounter, so a keyword
+    set can be intersected with the unread links directly in redis.
+    """
+
+    def __init__(self, redis=None, key=None):
+        super(KeywordIndex, self).__init__(redis=redis, key=key)
+
+    def key_of(self, keyword):
+        if isinstance(keyword, unicode):
+            keyword = keyword.encode("utf-8")
+        return "%s:%s" % (self.key, keyword)
+
+    def add(self, keyword, link, pipe=None):
+        pipe = self.redis if pipe is None else pipe
+        pipe.sadd(self.key, self.key_of(keyword))
+        pipe.sadd(self.key_of(keyword), self._pickle(link))
+
+    def discard(self, keyword, link, pipe=None):
+        pipe = self.redis if pipe is None else pipe
+        pipe.srem(self.key_of(keyword), self._pickle(link))
+
+    def links(self, keyword):
+        return set(self._unpickle(link)
+                   for link in self.redis.smembers(self.key_of(keyword)))
+
+    def postings(self, keywords):
+        """Pickled links of each keyword, in one round trip."""
+        with self.redis.pipeline(transaction=False) as pipe:
+            for keyword in keywords:
+                pipe.smembers(self.key_of(keyword))
+            return pipe.execute()
+
+    def clear(self, pipe=None):
+        pipe = self.redis if pipe is None else pipe
+        keys = list(self.redis.smembers(self.key))
+        if keys:
+            pipe.delete(*keys)
+        self._clear(pipe)
+
+    def _data(self, pipe=None):
+        pipe = self.redis if pipe is None else pipe
+        return {key: pipe.smembers(key) for key in pipe.smembers(self.key)}
+
+    def _repr_data(self):
+        return repr(self._data())
+
+
+class Timelines(RedisCollection):
+    """Sorts the links of each feed by their release time."""
+
+    def __init__(self, redis=None, key=None):
+        super(Timelines, self).__init__(redis=redis, key=key)
+
+    def key_of(self, feedurl):
+        if isinstance(feedurl, unicode):
+            feedurl = feedurl.encode("utf-8")
+        return "%s:%s" % (self.key, feedurl)
+
+    def add(self, feedurl, link, release, pipe=None):
+        pipe = self.redis if pipe is None else pipe
+        pipe.sadd(self.key, self.key_of(feedurl))
+        pipe.zadd(self.key_of(feedurl), float(release), self._pickle(link))
+
+    def discard(self, feedurl, link, pipe=None):
+        pipe = self.redis if pipe is None else pipe
+        pipe.zrem(self.key_of(feedurl), self._pickle(link))
+
+    def beyond(self, cap):
+        """Links of all feeds that are older than the newest *cap* ones."""
+        links = []
+        for key in self.redis.smembers(self.key):
+            surplus = self.redis.zcard(key) - cap
+            if surplus > 0:
+                links.extend(self._unpickle(link) for link in
+                             self.redis.zrange(key, 0, surplus - 1))
+        return links
+
+    def clear(self, pipe=None):
+        pipe = self.redis if pipe is None else pipe
+        keys = list(self.redis.smembers(self.key))
+        if keys:
+            pipe.delete(*keys)
+        self._clear(pipe)
+
+    def _data(self, pipe=None):
+        pipe = self.redis if pipe is None else pipe
+        return {key: pipe.zrange(key, 0, -1, withscores=True)
+                for key in pipe.smembers(self.key)}
+
+    def _repr_data(self):
+        return repr(self._data())
+
+
+class Fingerprints(RedisCollection):
+    """Finds links by similar minhash fingerprints.
+
+    Each link is filed under each band of its fingerprint, so lookups only
+    compare the few fingerprints that share a whole band.
+    """
+
+    def __init__(self, redis=None, key=None):
+        super(Fingerprints, self).__init__(redis=redis, key=key)
+        self.prints_key = "%s:prints" % self.key
+
+    def band_keys(self, fingerprint):
+        return ["%s:%i:%s" % (self.key, band, "-".join(
+                    "%x" % value for value in
+                    fingerprint[band * MINHASH_ROWS:(band + 1) * MINHASH_ROWS]))
+                for band in range(MINHASH_BANDS)]
+
+    def add(self, fingerprint, link, pipe=None):
+        pipe = self.redis if pipe is None else pipe
+        pipe.hset(self.prints_key, self._pickle(link), self._pickle(fingerprint))
+        for key in self.band_keys(fingerprint):
+            pipe.sadd(self.key, key)
+            pipe.sadd(key, self._pickle(link))
+
+    def discard(self, fingerprint, link, pipe=None):
+        pipe = self.redis if pipe is None else pipe
+        pipe.hdel(self.prints_key, self._pickle(link))
+        for key in self.band_keys(fingerprint):
+            pipe.srem(key, self._pickle(link))
+
+    def find_many(self, fingerprints):
+        """Links of the similar fingerprints of each, in two round trips."""
+        bands = [self.band_keys(fingerprint) if fingerprint else []
+                 for fingerprint in fingerprints]
+        with self.redis.pipeline(transaction=False) as pipe:
+            for keys in bands:
+                for key in keys:
+                    pipe.smembers(key)
+            members = iter(pipe.execute())
+        candidates = [set().union(*[next(members) for _ in keys])
+                      for keys in bands]
+        known = list(set().union(*candidates))
+        others = dict(zip(known, self.redis.hmget(self.prints_key, known)
+                          if known else []))
+        found = []
+        for fingerprint, links in zip(fingerprints, candidates):
+            similar = []
+            for link in links:
+                if others.get(link) is None:
+                    continue
+                score = similarity(fingerprint, self._unpickle(others[link]))
+                if score >= MINHASH_SIMILARITY:
+                    similar.append((score, self._unpickle(link)))
+            found.append([link for _, link in sorted(similar, reverse=True)])
+        return found
+
+    def clear(self, pipe=None):
+        pipe = self.redis if pipe is None else pipe
+        keys = list(self.redis.smembers(self.key)) + [self.prints_key]
+        pipe.delete(*keys)
+        self._clear(pipe)
+
+    def _data(self, pipe=None):
+        pipe = self.redis if pipe is None else pipe
+        return pipe.hgetall(self.prints_key)
+
+    def _repr_data(self):
+        return repr(self._data())
+
+
+class Version(RedisCollection):
+    """Counter bumped by every write that changes what the pages show."""
+
+    def __init__(self, redis=None, key=None):
+        super(Version, self).__init__(redis=redis, key=key)
+
+    def bump(self, pipe=None):
+        pipe = self.redis if pipe is None else pipe
+        return pipe.hincrby(self.key, "version", 1)
+
+    def get(self):
+        return int(self.redis.hget(self.key, "version") or 0)
+
+    def clear(self, pipe=None):
+        pipe = self.redis if pipe is None else pipe
+        self._clear(pipe)
+
+    def _data(self, pipe=None):
+        pipe = self.redis if pipe is None else pipe
+        return pipe.hget(self.key, "version")
+
+    def _repr_data(self):
+        return repr(self.get())
+
+
+class MetricTotals(RedisCollection):
+    """Metric series of all runs, summed up in one redis hash."""
+
+    def __init__(self, redis=None, key=None):
+        super(MetricTotals, self).__init__(redis=redis, key=key)
+
+    def add(self, series):
+        with self.redis.pipeline() as pipe:
+            for name, value in series.items():
+                pipe.hincrbyfloat(self.key, name, value)
+            pipe.execute()
+
+    def series(self):
+        return {name: float(value)
+                for name, value in self.redis.hgetall(self.key).items()}
+
+    def clear(self, pipe=None):
+        pipe = self.redis if pipe is None else pipe
+        self._clear(pipe)
+
+    def _data(self, pipe=None):
+        pipe = self.redis if pipe is None else pipe
+        return pipe.hgetall(self.key)
+
+    def _repr_data(self):
+        return repr(self._data())
+
+
+class Articles(RedisCollection):
+    """Articles split into small metadata records and compressed bodies.
+
+    The collection's key holds the set of stored links. The metadata of
+    each article is a redis hash of pickled fields, so single fields like
+    the read flag are written in place. The bodies of all articles live in
+    one more hash and are only decompressed by body().
+    """
+
+    BODY = "content"
+    # fields stored compressed, each in a hash of its own
+    BLOBS = {"content": "bodies", "rendered": "rendered"}
+
+    def __init__(self, redis=None, key=None):
+        super(Articles, self).__init__(redis=redis, key=key)
+
+    def key_of(self, link):
+        if isinstance(link, unicode):
+            link = link.encode("utf-8")
+        return "%s:meta:%s" % (self.key, link)
+
+    def blob_key(self, field):
+        return "%s:%s" % (self.key, self.BLOBS[field])
+
+    def __contains__(self, link):
+        return bool(self.redis.sismember(self.key, self._pickle(link)))
+
+    def __len__(self, pipe=None):
+        pipe = self.redis if pipe is None else pipe
+        return pipe.scard(self.key)
+
+    def __iter__(self):
+        for link in self.redis.sscan_iter(self.key):
+            yield self._unpickle(link)
+
+    def __getitem__(self, link):
+        article = self.getmany(link)[0]
+        if article is None:
+            raise KeyError(link)
+        return article
+
+    def __setitem__(self, link, article):
+        with self.redis.pipeline() as pipe:
+            self.put(link, article, pipe)
+            pipe.execute()
+
+    def put(self, link, article, pipe):
+        """Queue writing a whole article on a pipeline."""
+        fields = dict(article)
+        pipe.sadd(self.key, self._pickle(link))
+        for field in self.BLOBS:
+            if field in fields:
+                self.__set_blob(link, field, fields.pop(field), pipe)
+            else:
+                pipe.hdel(self.blob_key(field), self._pickle(link))
+        pipe.delete(self.key_of(link))
+        pipe.hmset(self.key_of(link), self.__encode(fields))
+
+    def __delitem__(self, link):
+        with self.redis.pipeline() as pipe:
+            self.remove(link, pipe)
+            removed = pipe.execute()[0]
+        if not removed:
+            raise KeyError(link)
+
+    def remove(self, link, pipe):
+        """Queue deleting a whole article on a pipeline."""
+        pipe.srem(self.key, self._pickle(link))
+        pipe.delete(self.key_of(link))
+        for field in self.BLOBS:
+            pipe.hdel(self.blob_key(field), self._pickle(link))
+
+    def __encode(self, fields):
+        return {field: self._pickle(value) for field, value in fields.items()}
+
+    def __decode(self, record):
+        return {field: self._unpickle(value) for field, value in record.items()}
+
+    def __set_blob(self, link, field, value, pipe):
+        pipe.hset(self.blob_key(field), self._pickle(link),
+                  zlib.compress(self._pickle(value)))
+
+    def get(self, link, default=None):
+        article = self.getmany(link)[0]
+        return default if article is None else article
+
+    def getmany(self, *links):
+        """Metadata of the given links, None for unknown ones."""
+        with self.redis.pipeline(transaction=False) as pipe:
+            for link in links:
+                pipe.hgetall(self.key_of(link))
+            records = pipe.execute()
+        return [self.__decode(record) if record else None
+                for record in records]
+
+    def set_fields(self, link, pipe=None, **fields):
+        """Overwrite single fields of a stored article in place.
+
+        Given a pipeline, the writes are only queued on it and the caller
+        vouches for the article to exist.
+        """
+        if pipe is None:
+            if link not in self:
+                raise KeyError(link)
+            with self.redis.pipeline() as pipe:
+                self.set_fields(link, pipe, **fields)
+                pipe.execute()
+            return
+        for field in self.BLOBS:
+            if field in fields:
+                self.__set_blob(link, field, fields.pop(field), pipe)
+        if fields:
+            pipe.hmset(self.key_of(link), self.__encode(fields))
+
+    def blob(self, link, field=BODY):
+        """A compressed field of an article, None if it is not stored."""
+        blob = self.redis.hget(self.blob_key(field), self._pickle(link))
+        return self._unpickle(zlib.decompress(blob)) if blob else None
+
+    def body(self, link):
+        """Content of an article, decompressed."""
+        return self.blob(link) or ""
+
+    def bodies(self, links):
+        """Contents of several articles in one round trip, decompressed."""
+        if not links:
+            return []
+        blobs = self.redis.hmget(self.blob_key(self.BODY),
+                                 [self._pickle(link) for link in links])
+        return [self._unpickle(zlib.decompress(blob)) if blob else ""
+                for blob in blobs]
+
+    def keys(self):
+        return list(self)
+
+    def itervalues(self, chunk=100):
+        links = []
+        for link in self:
+            links.append(link)
+            if len(links) >= chunk:
+                for article in self.getmany(*links):
+                    if article:
+                        yield article
+                links = []
+        for article in self.getmany(*links):
+            if article:
+                yield article
+
+    def values(self):
+        return list(self.itervalues())
+
+    def clear(self, pipe=None):
+        pipe = self.redis if pipe is None else pipe
+        keys = [self.key_of(link) for link in self]
+        if keys:
+            pipe.delete(*keys)
+        for field in self.BLOBS:
+            pipe.delete(self.blob_key(field))
+        self._clear(pipe)
+
+    def _data(self, pipe=None):
+        return {article["link"]: article for article in self.itervalues()}
+
+    def _repr_data(self):
+        return repr(self._data())
 
 
 class Bot():
+    """Handle on the config and database, meant to live as long as the process.
+
+    Entering it again only reloads the config if its file changed, and
+    reconnects if the storage in it changed. Leaving it only writes the
+    config if something changed. Both are serialized, so threads can share
+    one Bot.
+    """
+
+    def __init__(self, configfile=CONFIGFILE, connection=None):
+        self.configfile = configfile
+        self.config = None
+        self.database = None
+        self.connection = connection
+        self.storage = None
+        self.search_index = None
+        self.__lock = RLock()
+
     def __enter__(self):
-        self.config = Config(CONFIGFILE)
-        self.database = initialize_database(self.config)
+        with self.__lock:
+            if self.config is None:
+                self.config = Config(self.configfile)
+                self.connection = self.connection or connect(self.config)
+                self.storage = backend(self.config)
+                self.open_database()
+            elif self.config.reload():
+                if backend(self.config) != self.storage:
+                    self.connection = connect(self.config)
+                    self.storage = backend(self.config)
+                    self.open_database()
+                elif any(self.config["redis_keys"].get(name) != piece.key
+                         for name, piece in self.database.items()):
+                    self.open_database()
         return self
 
     def __exit__(self, *args, **kwargs):
+        with self.__lock:
+            self.config.save(self.database)
+
+    def open_database(self):
+        missing = [i for i in INDEXES if i not in self.config["redis_keys"]]
+        weighted = "keyword_weights" in self.config["redis_keys"]
+        learned = "feed_cycles" in self.config["redis_keys"]
+        searchable = os.path.exists(self.config["search_index"])
+        self.database = initialize_database(self.config, self.connection)
+        try:
+            self.search_index = SearchIndex(self.config["search_index"])
+        except sqlite3.OperationalError, e:
+            # e.g. a SQLite built without FTS5, the rest works without it
+            logging.warn("Search is disabled: %s", e)
+            self.search_index = None
+        if not weighted:
+            # clicks counted before weights decayed count as made just now
+            now = time()
+            weights = self.database["keyword_weights"]
+            with self.connection.pipeline() as pipe:
+                for keyword, count in self.database["keyword_clicks"].items():
+                    weights.set_weight(keyword, float(count), now, pipe=pipe)
+                pipe.execute()
+        if not learned:
+            # cycles used to be learned into subscriptions of config feeds
+            subscriptions = self.database["subscriptions"]
+            cycles = self.database["feed_cycles"]
+            for feedurl in set(self.config["abos"]) & set(subscriptions):
+                cycles[feedurl] = subscriptions.pop(feedurl)["cycle"]
+        if missing:
+            self.reindex()
+        if not searchable:
+            self.index_search()
+        # remember new or migrated collections right away
         self.config.save(self.database)
 
-    def relevance_of_keyword(self, keyword):
-        """Retrieve relevance factor of a keyword."""
-        return self.database["keyword_clicks"][keyword[0]]
+    def move_storage(self, storage):
+        """Copy all collections to another backend and use it from now on.
+
+        The copied collections are left in the old backend.
+        """
+        target = connect(dict(self.config, storage=storage))
+        for piece in self.database.values():
+            copy_keys(self.connection, target, piece.key + "*")
+        self.config["storage"] = storage
+        self.connection = target
+        self.storage = backend(self.config)
+        self.open_database()
+
+    def scorer(self, now=None):
+        """Scorer holding the keyword weights decayed until now."""
+        return Scorer(self.database["keyword_weights"].items(), now)
+
+    def relevant_keywords(self):
+        """(keyword, relevance) pairs of all clicked keywords, best first."""
+        return self.scorer().ranked_keywords()
+
+    def relevances_of_articles(self, articles):
+        """Relevance factors of several articles in one round trip."""
+        return self.scorer().score_articles(articles).tolist()
+
+    def ranking_scores(self, articles):
+        """Scores of articles in the ranking, by the weights of their keywords.
+
+        Only the weights of the keywords of the articles are read.
+        """
+        keywords = list(set().union(*[article["keywords"]
+                                      for article in articles]))
+        weights = self.database["keyword_weights"].getmany(*keywords) \
+            if keywords else []
+        scorer = Scorer([(keyword, weight) for keyword, weight in
+                         zip(keywords, weights) if weight is not None],
+                        epoch=self.database["ranking"].epoch())
+        relevances = scorer.score_articles(articles)
+        return [relevance + article["release"] / RANK_TIEBREAK
+                for article, relevance in zip(articles, relevances.tolist())]
+
+    def index_article(self, article):
+        """Keep the indexes in step with a stored article."""
+        self.index_articles([article])
+
+    def index_articles(self, articles, store=False):
+        """Keep the indexes in step with stored articles.
 
+        Scoring runs in a transaction watching the keyword weights and the
+        epoch of the ranking, so a concurrent like_keyword cannot slip in
+        between. With store, the articles themselves are written in the
+        same transaction.
+        """
+        if not articles:
+            return
+        ranking = self.database["ranking"]
+        unread = self.database["unread"]
+        keyword_index = self.database["keyword_index"]
+        weights = self.database["keyword_weights"]
 
-    def relevance_of_article(self, article):
-        """Retrieve relevance factor of an article."""
-        return sum([(self.database["keyword_clicks"][k] or 0)
-                    for k in article["keywords"]])
+        def index(pipe):
+            scores = self.ranking_scores(articles)
+            pipe.multi()
+            for article, score in zip(articles, scores):
+                link = article["link"]
+                if store:
+                    self.database["articles"].put(link, article, pipe)
+                self.database["timeline"].set_score(link, article["release"],
+                                                    pipe=pipe)
+                if article.get("feed"):
+                    self.database["feed_timelines"].add(
+                        article["feed"], link, article["release"], pipe=pipe)
+                if article["read"]:
+                    ranking.discard_member(link, pipe=pipe)
+                    unread.discard_member(link, pipe=pipe)
+                    for keyword in article["keywords"]:
+                        keyword_index.discard(keyword, link, pipe=pipe)
+                else:
+                    ranking.set_score(link, score, pipe=pipe)
+                    unread.set_score(link, article["release"], pipe=pipe)
+                    for keyword in article["keywords"]:
+                        keyword_index.add(keyword, link, pipe=pipe)
+                self.database["article_ids"].set(article["id"], link, pipe=pipe)
+                if article.get("fingerprint") is not None:
+                    self.database["fingerprints"].add(article["fingerprint"],
+                                                      link, pipe=pipe)
+                self.database["seen_links"].add(
+                    [source for _, source in
+                     article.get("sources") or [(None, link)]], pipe=pipe)
+            self.database["data_version"].bump(pipe=pipe)
+
+        self.connection.transaction(index, weights.key, ranking.epoch_key)
+
+    def reindex(self):
+        """Rebuild the indexes from all stored articles."""
+        for piece in INDEXES:
+            self.database[piece].clear()
+        chunk = []
+        for article in self.database["articles"].itervalues():
+            if "id" not in article:
+                article["id"] = article_id(article["link"])
+                self.database["articles"].set_fields(article["link"],
+                                                     id=article["id"])
+            chunk.append(article)
+            if len(chunk) >= WRITE_BATCH:
+                self.index_articles(chunk)
+                chunk = []
+        self.index_articles(chunk)
+        archived = self.database["archive_index"].keys()
+        with self.connection.pipeline() as pipe:
+            for link in archived:
+                self.database["article_ids"].set(article_id(link), link,
+                                                 pipe=pipe)
+            self.database["seen_links"].add(archived, pipe=pipe)
+            pipe.execute()
+
+    def store_article(self, article):
+        self.store_articles([article])
+
+    def store_articles(self, articles):
+        """Write and index articles in one transaction.
+
+        The search index is updated right after, outside the transaction.
+        """
+        for article in articles:
+            article.setdefault("id", article_id(article["link"]))
+        self.index_articles(articles, store=True)
+        if articles and self.search_index is not None:
+            self.search_index.add(articles)
+
+    def index_search(self):
+        """Add all stored and archived articles to the search index."""
+        search_index = self.search_index
+        if search_index is None:
+            return
+        chunk = []
+        for article in self.database["articles"].itervalues():
+            article["content"] = self.database["articles"].body(
+                article["link"])
+            chunk.append(article)
+            if len(chunk) >= WRITE_BATCH:
+                search_index.add(chunk)
+                chunk = []
+        for _, article in self.archive.scan():
+            chunk.append(article)
+            if len(chunk) >= WRITE_BATCH:
+                search_index.add(chunk)
+                chunk = []
+        search_index.add(chunk)
+
+    def search(self, query, offset=0, number=20):
+        """Total number of articles matching a query and a page of them."""
+        if self.search_index is None:
+            return 0, []
+        return self.search_index.search(query, offset, number)
+
+    def originals(self, feedurl, entries, fingerprints):
+        """Stored article each entry of a feed is another source of.
+
+        An article only counts if its headline overlaps with the entry's
+        and no entry of this feed went into it yet, so templated
+        summaries do not fold the stories of one feed together. None
+        stands for entries that are new stories.
+        """
+        similar = self.database["fingerprints"].find_many(fingerprints)
+        known = list(set(link for links in similar for link in links))
+        stored = dict(zip(known, self.database["articles"].getmany(*known)
+                          if known else []))
+        originals = []
+        for entry, links in zip(entries, similar):
+            original = None
+            for link in links:
+                article = stored.get(link)
+                if article and feedurl not in feeds_of(article) and \
+                        same_headline(entry.get("title"), article["title"]):
+                    original = link
+                    break
+            originals.append(original)
+        return originals
+
+    def unseen(self, entries):
+        """The feed entries whose links were not fetched before."""
+        seen = self.database["seen_links"].seen(
+            [entry.link for entry in entries])
+        return [entry for entry, known in zip(entries, seen) if not known]
+
+    def add_sources(self, sources):
+        """Fold further (feedurl, link) sources into stored articles.
+
+        Takes a dict of lists of sources by the link of their article.
+        """
+        links = list(sources)
+        articles = self.database["articles"].getmany(*links)
+        with self.connection.pipeline() as pipe:
+            for link, article in zip(links, articles):
+                if article is None:
+                    continue  # archived or gone
+                known = article.get("sources") or []
+                new = [source for source in sources[link]
+                       if source not in known]
+                if new:
+                    self.database["articles"].set_fields(
+                        link, pipe=pipe, sources=known + new)
+            self.database["seen_links"].add(
+                [source for link in links for _, source in sources[link]],
+                pipe=pipe)
+            self.database["data_version"].bump(pipe=pipe)
+            pipe.execute()
+
+    def link_of(self, article_id):
+        """Link of the article with the given id, None if unknown."""
+        return self.database["article_ids"].get(article_id)
 
     def update_article(self, link, **kwargs):
-        article = self.database["articles"][link]
-        article.update(**kwargs)
-        self.database["articles"][link] = article
+        article = self.database["articles"].get(link)
+        if article is None:
+            if link in self.database["archive_index"]:
+                return  # archived articles stay as they were
+            raise KeyError(link)
+        if all(article.get(field) == value
+               for field, value in kwargs.items()):
+            return  # unchanged, so cached pages stay valid
+        self.database["articles"].set_fields(link, **kwargs)
+        article.update(kwargs)
+        self.index_article(article)
 
-    def hot_articles(self, offset=0, number=12, since=259200, keyword=None):
-        """Retrieve most relevant articles."""
-        unread_young = lambda x: not x["read"] and x["release"] >= since
-        relevance_of_article = lambda x: self.relevance_of_article(x)
-
-        # look for yound, unread articles
-        articles = []
-        for article in self.database["articles"].values():
-            if not unread_young(article):
+    def data_version(self):
+        """Number bumped whenever stored articles or their ranking change."""
+        return self.database["data_version"].get()
+
+    def load_article(self, link):
+        """Metadata, content and rendered content of an article.
+
+        Content rendered by an older RENDER_VERSION is rendered again and
+        stored on the way.
+        """
+        articles = self.database["articles"]
+        if link not in articles:
+            location = self.database["archive_index"].get(link)
+            if location is None:
+                raise KeyError(link)
+            article = self.archive.read(location)
+            article["spaned_content"] = render_content(article["content"])
+            return article
+        article = articles[link]
+        article["content"] = articles.body(link)
+        rendered = articles.blob(link, "rendered")
+        if not rendered or rendered[0] != RENDER_VERSION:
+            METRICS.count("cache_misses", cache="rendered")
+            rendered = (RENDER_VERSION, render_content(article["content"]))
+            articles.set_fields(link, rendered=rendered)
+        else:
+            METRICS.count("cache_hits", cache="rendered")
+        article["spaned_content"] = rendered[1]
+        return article
+
+    @property
+    def archive(self):
+        return Archive(self.config["archive"])
+
+    def expire(self, now=None):
+        """Move articles out of redis according to the retention policies.
+
+        Returns the number of archived articles.
+        """
+        now = now or time()
+        policy = self.config["retention"]
+        timeline = self.database["timeline"]
+        unread = self.database["unread"]
+
+        expired = set()
+        if policy.get("max_age"):
+            expired.update(link for link, _ in timeline.items_by_score(
+                max_score=now - policy["max_age"]))
+        if policy.get("read_max_age"):
+            old = [link for link, _ in timeline.items_by_score(
+                max_score=now - policy["read_max_age"])]
+            with unread.redis.pipeline() as pipe:
+                for link in old:
+                    unread.get_score(link, pipe=pipe)
+                scores = pipe.execute()
+            expired.update(link for link, score in zip(old, scores)
+                           if score is None)
+        if policy.get("per_feed"):
+            expired.update(self.database["feed_timelines"].beyond(
+                policy["per_feed"]))
+        if policy.get("seen_max_age"):
+            self.database["seen_links"].forget(now - policy["seen_max_age"])
+
+        archive = self.archive
+        articles = self.database["articles"]
+        expired = list(expired)
+        for start in range(0, len(expired), WRITE_BATCH):
+            chunk = expired[start:start + WRITE_BATCH]
+            found = [article for article in articles.getmany(*chunk)
+                     if article]
+            for link in set(chunk) - set(a["link"] for a in found):
+                timeline.discard_member(link)
+            if not found:
                 continue
-            articles.append(article)
+            links = [article["link"] for article in found]
+            for article, content in zip(found, articles.bodies(links)):
+                article["content"] = content
+            self.database["archive_index"].update(
+                zip(links, archive.append_many(found)))
+            self.drop_articles(found)
+        return len(expired)
 
-        # sort by relevance and cut off slice
-        if not number:
-            return sorted(articles,
-                          key=relevance_of_article,
-                          reverse=True)
-        return sorted(articles,
-                      key=relevance_of_article,
-                      reverse=True)[offset*number:(offset*number+number)]
+    def drop_article(self, article):
+        """Remove an article and its index entries from redis."""
+        self.drop_articles([article])
+
+    def drop_articles(self, articles):
+        """Remove articles and their index entries in one transaction."""
+        with self.connection.pipeline() as pipe:
+            for article in articles:
+                link = article["link"]
+                self.database["timeline"].discard_member(link, pipe=pipe)
+                self.database["ranking"].discard_member(link, pipe=pipe)
+                self.database["unread"].discard_member(link, pipe=pipe)
+                for keyword in article["keywords"]:
+                    self.database["keyword_index"].discard(keyword, link,
+                                                           pipe=pipe)
+                if article.get("feed"):
+                    self.database["feed_timelines"].discard(
+                        article["feed"], link, pipe=pipe)
+                if article.get("fingerprint") is not None:
+                    self.database["fingerprints"].discard(
+                        article["fingerprint"], link, pipe=pipe)
+                self.database["articles"].remove(link, pipe)
+            self.database["data_version"].bump(pipe=pipe)
+            pipe.execute()
+
+    def like_keyword(self, keyword, amount=1):
+        """Count a click on a keyword and add it to its articles' scores.
+
+        Only the unread articles with the keyword are written, by the
+        click grown forward from the epoch of the ranking.
+        """
+        clicks = self.database["keyword_clicks"]
+        weights = self.database["keyword_weights"]
+        ranking = self.database["ranking"]
+        keyword_index = self.database["keyword_index"]
+
+        def like(pipe):
+            count = clicks[keyword] + amount
+            weight, stamp = weights.get(keyword, (0.0, 0))
+            links = keyword_index.links(keyword)
+            now = time()
+            increment = forward(amount, now, ranking.epoch())
+            pipe.multi()
+            clicks.set_count(keyword, count, pipe=pipe)
+            weights.set_weight(keyword, decayed(weight, stamp, now) + amount,
+                               now, pipe=pipe)
+            for link in links:
+                ranking.increment_score(link, increment, pipe=pipe)
+            self.database["data_version"].bump(pipe=pipe)
+
+        clicks.redis.transaction(like, clicks.key, weights.key,
+                                 ranking.epoch_key,
+                                 keyword_index.key_of(keyword))
+
+    def rebase_ranking(self, now=None):
+        """Move the epoch of the ranking up to now once it is RANK_REBASE old.
+
+        All scores are scaled back to the new epoch, which keeps them and
+        the release times breaking their ties within float precision.
+        """
+        now = time() if now is None else now
+        ranking = self.database["ranking"]
+        unread = self.database["unread"]
+
+        def rebase(pipe):
+            epoch = ranking.epoch()
+            if now - epoch < RANK_REBASE:
+                return
+            scale = forward(1.0, epoch, now)
+            members = ranking.redis.zrange(ranking.key, 0, -1,
+                                           withscores=True)
+            with unread.redis.pipeline(transaction=False) as lookup:
+                for member, _ in members:
+                    lookup.zscore(unread.key, member)
+                releases = lookup.execute()
+            pipe.multi()
+            for (member, score), release in zip(members, releases):
+                tiebreak = (release or 0) / RANK_TIEBREAK
+                pipe.zadd(ranking.key, (score - tiebreak) * scale + tiebreak,
+                          member)
+            ranking.set_epoch(now, pipe=pipe)
+
+        ranking.redis.transaction(rebase, ranking.key, ranking.epoch_key)
+
+    def hot_articles(self, offset=0, number=12, since=259200, keyword=None):
+        """Retrieve most relevant articles, optionally about one keyword."""
+        skip = offset * (number or 0)
+        links = self.ranked_links(since, keyword, skip,
+                                  skip + number if number else None)
+        if not links:
+            return []
+        return [article for article in
+                self.database["articles"].getmany(*links) if article]
+
+    def ranked_links(self, since=259200, keyword=None, start=0, stop=None):
+        """Links of the unread articles released since, most relevant first.
+
+        Without a keyword the ranking is walked down in chunks and only
+        the release times of the links on the way are looked up. With one,
+        just the links of the keyword are looked up in the ranking.
+        """
+        ranking = self.database["ranking"]
+        unread = self.database["unread"]
+        if keyword is not None:
+            members = list(ranking.redis.smembers(
+                self.database["keyword_index"].key_of(keyword)))
+            with ranking.redis.pipeline(transaction=False) as pipe:
+                for member in members:
+                    pipe.zscore(ranking.key, member)
+                    pipe.zscore(unread.key, member)
+                values = pipe.execute()
+            ranked = sorted(((score, member) for member, score, release in
+                             zip(members, values[::2], values[1::2])
+                             if score is not None and release is not None
+                             and release >= since), reverse=True)
+            return [ranking._unpickle(member)
+                    for _, member in ranked[start:stop]]
+
+        chunk = 1000 if stop is None else max(100, stop)
+        links = []
+        rank = 0
+        while stop is None or len(links) < stop:
+            members = ranking.redis.zrevrange(ranking.key, rank,
+                                              rank + chunk - 1)
+            if not members:
+                break
+            rank += chunk
+            with ranking.redis.pipeline(transaction=False) as pipe:
+                for member in members:
+                    pipe.zscore(unread.key, member)
+                releases = pipe.execute()
+            links.extend(member for member, release in zip(members, releases)
+                         if release is not None and release >= since)
+        return [ranking._unpickle(member) for member in links[start:stop]]
 
     def subscribe_feed(self, feedurl):
         self.config["abos"].append(feedurl)
-        self.database["subscriptions"].add({"feedurl": feedurl, "cycle": 1})
+        self.database["subscriptions"][feedurl] = {"feedurl": feedurl,
+                                                   "cycle": 1}
 
-    def curate(self):
-        def __feed_worker(pid, inqueue, outqueue):
-            try:
-                while True:
-                    feedurl = inqueue.get(timeout=1)
-                    logging.debug("%i Queueing %s", pid, feedurl)
-                    try:
-                        response = requests.get(feedurl, timeout=1.0, verify=False)
-                    except (requests.Timeout, requests.ConnectionError, requests.TooManyRedirects):
-                        logging.debug("%i Timeout %s", pid, feedurl)
-                        inqueue.task_done()
-                        continue
-                    except requests.exceptions.MissingSchema:
-                        feedurl = "http://%s" % feedurl
-                        try:
-                            response = requests.get(feedurl, timeout=1.0, verify=False)
-                        except:
-                            logging.debug("%i Cannot handle %s", pid, feedurl)
-                            inqueue.task_done()
-                            continue
-                    if response.status_code != 200:
-                        logging.warn("%i Non-200 status code %i: %s", pid, response.status_code, feedurl)
-                    feed = feedparser.parse(response.text)
-                    logging.debug("%i There are %i entries in %s", pid, len(feed.entries), feedurl)
-                    for entry in feed.entries:
-                        if entry.link not in self.database["articles"]:
-                            logging.debug("%i put %s" , pid, entry.link)
-                            outqueue.put(entry)
+    def feeds(self):
+        """All subscribed feed urls."""
+        return set(self.config["abos"] + self.database["subscriptions"].keys())
+
+    def cycles(self):
+        """Polling cycle in seconds of each subscribed feed."""
+        cycles = {feedurl: self.config["min_cycle"]
+                  for feedurl in self.feeds()}
+        for subscription in self.database["subscriptions"].itervalues():
+            cycles[subscription["feedurl"]] = max(self.config["min_cycle"],
+                                                  subscription["cycle"])
+        for feedurl, cycle in self.database["feed_cycles"].items():
+            if feedurl in cycles:
+                cycles[feedurl] = max(self.config["min_cycle"], cycle)
+        return cycles
+
+    def set_cycle(self, feedurl, cycle):
+        """Remember the learned cycle of a feed, subscribed or not."""
+        self.database["feed_cycles"][feedurl] = int(cycle)
+
+    def watch(self):
+        """Poll every feed on its own, learned cycle until interrupted.
+
+        The config is reloaded before each round, so feeds added to it
+        meanwhile are polled from then on and removed ones no longer.
+        """
+        schedule = []
+        scheduled = set()
+        failures = dict()
+        with self:
+            # kept for all rounds, the parser forked before any thread
+            parser = self.parser()
+            fetcher = self.fetcher()
+        try:
+            while True:
+                with self:
+                    feeds = self.feeds()
+                    for feedurl in feeds - scheduled:
+                        heappush(schedule, (time(), feedurl))
+                        scheduled.add(feedurl)
+
+                    due = []
+                    while schedule and schedule[0][0] <= time():
+                        feedurl = heappop(schedule)[1]
+                        if feedurl in feeds:
+                            due.append(feedurl)
                         else:
-                            logging.debug("%i ign %s" , pid, entry.link)
-                    inqueue.task_done()
-            except Empty:
-                pass
+                            scheduled.discard(feedurl)
+                            failures.pop(feedurl, None)
+                    if due:
+                        self.poll(due, schedule, failures, fetcher, parser)
+                if not due:
+                    sleep(max(0, min(60, schedule[0][0] - time()))
+                          if schedule else 60)
+        finally:
+            parser.close()
+            fetcher.session.close()
+
+    def poll(self, due, schedule, failures, fetcher=None, parser=None):
+        """Curate the due feeds and schedule their next polls."""
+        logging.info("Polling %i feeds", len(due))
+        outcomes = self.curate(due, verbose=False, fetcher=fetcher,
+                               parser=parser)
+        cycles = self.cycles()
+        for feedurl in due:
+            outcome = outcomes.get(feedurl, {"failed": True})
+            cycle = cycles.get(feedurl, self.config["min_cycle"])
+            if outcome["failed"]:
+                failures[feedurl] = failures.get(feedurl, 0) + 1
+                delay = cycle * 2 ** failures[feedurl]
+            else:
+                failures.pop(feedurl, None)
+                if outcome["interval"]:
+                    cycle = outcome["interval"]
+                delay = cycle
+            cycle = min(self.config["max_cycle"],
+                        max(self.config["min_cycle"], cycle))
+            if cycle != cycles.get(feedurl):
+                self.set_cycle(feedurl, cycle)
+            delay = min(self.config["max_cycle"], delay)
+            delay *= random.uniform(1 - POLL_JITTER, 1 + POLL_JITTER)
+            heappush(schedule, (time() + delay, feedurl))
+
+    def fetcher(self):
+        """Fetcher for curation runs, as the config tells."""
+        return Fetcher(per_host=self.config["per_host"],
+                       hosts=self.config["workers"],
+                       page_limit=self.config["page_limit"],
+                       retries=self.config["retry_budget"])
+
+    def parser(self):
+        """Parser for curation runs, as the config tells.
+
+        Its processes are forked from here, so call it before starting any
+        thread.
+        """
+        return Parser(self.config["parsers"], self.config["parse_seconds"],
+                      self.config["parse_memory"])
+
+    def curate(self, feedurls=None, verbose=True, fetcher=None, parser=None):
+        """Fetch new articles of the given or all feeds.
 
-        def __art_worker(pid, queue):
+        A fetcher and parser kept over several runs may be given, else they
+        are made for this run. Returns the outcome of each polled feed:
+        whether it failed and the average interval between its entries, if
+        that could be told.
+        """
+        tstart = time()
+        if fetcher is None:
+            fetcher = self.fetcher()
+        else:
+            fetcher.retries = self.config["retry_budget"]
+        # forked before any thread of the run is started
+        own_parser = parser is None
+        if own_parser:
+            parser = self.parser()
+        counts = {"feeds": 0, "entries": 0, "articles": 0, "duplicates": 0}
+        counts_lock = Lock()
+        # stories queued in this run but not stored yet, by canonical link
+        # and by fingerprint, the sources found for them meanwhile and the
+        # canonical links written since the feeds were checked
+        pending = dict()
+        pending_prints = dict()
+        pending_sources = defaultdict(list)
+        written = set()
+        # queued stories of each feed, the validators of its response saved
+        # once they are all written, and the feeds a write failed for
+        unsettled = defaultdict(int)
+        unsaved_validators = dict()
+        unwritten = set()
+        pending_lock = Lock()
+        finished = Event()
+        outcomes = dict()
+
+        def __count(key):
+            with counts_lock:
+                counts[key] += 1
+
+        def __pending_original(source, entry, fingerprint):
+            original = pending.get(canonical_link(entry.link))
+            if original is None and fingerprint is not None:
+                for other, (pending_link, feed, title) in \
+                        pending_prints.items():
+                    feeds = [feed] + [feedurl for feedurl, _ in
+                                      pending_sources.get(pending_link, [])]
+                    if source not in feeds and \
+                            same_headline(entry.get("title"), title) and \
+                            similarity(fingerprint, other) >= \
+                            MINHASH_SIMILARITY:
+                        original = pending_link
+                        break
+            return original
+
+        def __queue(source, entries, outqueue):
+            """Queue the entries of a feed that are no story already known.
+
+            Costs three round trips per feed, however many entries it has.
+            """
+            known = len(entries)
+            entries = self.unseen(entries)
+            METRICS.count("cache_hits", known - len(entries), cache="seen_links")
+            fingerprints = [entry_fingerprint(entry) for entry in entries]
+            originals = self.originals(source, entries, fingerprints)
+            fresh = []
+            folded = defaultdict(list)
+            with pending_lock:
+                for entry, fingerprint, original in zip(entries, fingerprints,
+                                                        originals):
+                    link = entry.link
+                    if canonical_link(link) in written:
+                        continue
+                    original = __pending_original(source, entry,
+                                                  fingerprint) or original
+                    if original is None:
+                        pending[canonical_link(link)] = link
+                        if fingerprint is not None:
+                            pending_prints[fingerprint] = (
+                                link, source, entry.get("title"))
+                        fresh.append((source, entry, fingerprint))
+                        unsettled[source] += 1
+                        continue
+                    logging.debug("%s folded into %s", link, original)
+                    __count("duplicates")
+                    if canonical_link(original) in pending:
+                        pending[canonical_link(link)] = original
+                        pending_sources[original].append((source, link))
+                        unsettled[source] += 1
+                    else:
+                        folded[original].append((source, link))
+                if folded:
+                    self.add_sources(folded)
+            for item in fresh:
+                # blocks while the article workers are behind
+                outqueue.put(item)
+                __count("entries")
+
+        def __settle(link, fingerprint):
+            """Forget a queued story, returning the sources folded into it."""
+            sources = [(None, link)] + pending_sources.pop(link, [])
+            for _, source in sources:
+                pending.pop(canonical_link(source), None)
+                written.add(canonical_link(source))
+            pending_prints.pop(fingerprint, None)
+            return sources[1:]
+
+        def __release(source):
+            """Save the validators of a feed once its stories are written.
+
+            Until then, a failed run must not get a 304 for them next time.
+            """
+            if unsettled[source] or source not in unsaved_validators:
+                return
+            validators = unsaved_validators.pop(source)
+            if source not in unwritten:
+                self.database["feed_validators"][source] = validators
+
+        def __poll(pid, feedurl, outqueue):
+            """Fetch a feed and queue its new entries."""
+            logging.debug("%i Queueing %s", pid, feedurl)
+            source = feedurl
+            validators = self.database["feed_validators"].get(source) or {}
+            headers = dict()
+            if validators.get("etag"):
+                headers["If-None-Match"] = validators["etag"]
+            if validators.get("modified"):
+                headers["If-Modified-Since"] = validators["modified"]
+            host = urlparse(feedurl).hostname
             try:
-                while True:
-                    entry = queue.get(timeout=1)
-                    logging.debug("%i Getting %s", pid, entry.link)
-                    article = get_article(entry)
-                    self.database["articles"][article["link"]] = article
+                with METRICS.timer("stage", stage="feed"):
+                    response = fetcher.get(feedurl, headers=headers)
+            except (requests.Timeout, requests.ConnectionError, requests.TooManyRedirects):
+                logging.debug("%i Timeout %s", pid, feedurl)
+                METRICS.count("failures", kind="feed", host=host)
+                return
+            except requests.exceptions.MissingSchema:
+                feedurl = "http://%s" % feedurl
+                response = fetcher.get(feedurl, headers=headers)
+            if response.status_code < 400:
+                outcomes[source]["failed"] = False
+            else:
+                METRICS.count("failures", kind="feed", host=host)
+            if response.status_code == 304:
+                logging.debug("%i Not modified %s", pid, feedurl)
+                METRICS.count("cache_hits", cache="feed_not_modified")
+                return
+            if response.status_code != 200:
+                logging.warn("%i Non-200 status code %i: %s", pid, response.status_code, feedurl)
+            METRICS.count("fetched_bytes", len(response.content),
+                          kind="feed", host=host)
+            digest = hashlib.sha1(response.content).hexdigest()
+            fresh = {"etag": response.headers.get("ETag"),
+                     "modified": response.headers.get("Last-Modified"),
+                     "digest": digest}
+            if digest == validators.get("digest"):
+                logging.debug("%i Unchanged %s", pid, feedurl)
+                METRICS.count("cache_hits", cache="feed_digest")
+                if response.status_code == 200 and fresh != validators:
+                    self.database["feed_validators"][source] = fresh
+                return
+            feed = feedparser.parse(response.text)
+            logging.debug("%i There are %i entries in %s", pid, len(feed.entries), feedurl)
+            outcomes[source]["interval"] = posting_interval(feed.entries)
+            __queue(source, feed.entries, outqueue)
+            if response.status_code == 200:
+                with pending_lock:
+                    unsaved_validators[source] = fresh
+                    __release(source)
+
+        def __feed_worker(pid, inqueue, outqueue):
+            while True:
+                try:
+                    feedurl = inqueue.get_nowait()
+                except Empty:
+                    return
+                outcomes[feedurl] = {"failed": True, "interval": None}
+                try:
+                    __poll(pid, feedurl, outqueue)
+                except Exception, e:
+                    # backed off like any failing feed, the others go on
+                    logging.warn("%i Cannot handle %s: %s", pid, feedurl, e)
+                    METRICS.count("failures", kind="feed",
+                                  host=urlparse(feedurl).hostname)
+                    outcomes[feedurl]["failed"] = True
+                finally:
+                    __count("feeds")
+                    inqueue.task_done()
+
+        def __art_worker(pid, queue, outqueue):
+            while True:
+                item = queue.get()
+                if item is None:
+                    queue.task_done()
+                    return
+                feedurl, entry, fingerprint = item
+                logging.debug("%i Getting %s", pid, entry.link)
+                article = None
+                try:
+                    article = get_article(entry, fetcher,
+                                          self.database["image_sizes"], parser)
+                    article["feed"] = feedurl
+                    article["fingerprint"] = fingerprint
+                except Exception, e:
+                    logging.warn("%i Cannot get %s: %s", pid, entry.link, e)
+                    METRICS.count("failures", kind="article",
+                                  host=urlparse(entry.link).hostname)
+                finally:
+                    outqueue.put((feedurl, entry.link, fingerprint, article))
+                    __count("articles")
                     queue.task_done()
-            except Empty:
-                pass
+
+        def __writer(pid, queue):
+            """Write the fetched articles in batches of WRITE_BATCH."""
+            done = False
+            while not done:
+                batch = [queue.get()]
+                while batch[-1] is not None and len(batch) < WRITE_BATCH:
+                    try:
+                        batch.append(queue.get_nowait())
+                    except Empty:
+                        break
+                done = batch[-1] is None
+                articles = []
+                failed = []
+                feeds = []
+                try:
+                    with pending_lock:
+                        for feedurl, link, fingerprint, article in \
+                                batch[:-1] if done else batch:
+                            sources = [(feedurl, link)] + \
+                                __settle(link, fingerprint)
+                            feeds.extend(source for source, _ in sources)
+                            if article is None:
+                                # remembered as seen, so it is not fetched
+                                # again
+                                failed.extend(source for _, source in sources)
+                            else:
+                                article["sources"] = sources
+                                articles.append(article)
+                        with METRICS.timer("stage", stage="store"):
+                            self.store_articles(articles)
+                        self.database["seen_links"].add(failed)
+                except Exception, e:
+                    # the batch is fetched again next run, the others go on
+                    logging.warn("%i Cannot store %i articles: %s", pid,
+                                 len(articles), e)
+                    METRICS.count("failures", kind="store")
+                    with pending_lock:
+                        unwritten.update(feeds)
+                finally:
+                    with pending_lock:
+                        for feedurl in feeds:
+                            unsettled[feedurl] -= 1
+                            __release(feedurl)
+                    for _ in batch:
+                        queue.task_done()
 
 
-        def __progress(pid, queue):
-            maximum = 1
+        def __progress(pid, feeds):
             tick = 0
             tstart = time()
             while True:
-                remaining = queue.qsize()
-                maximum = max(remaining, maximum)
-                percent = 1. - float(remaining) / maximum
+                with counts_lock:
+                    done = counts["feeds"] + counts["articles"]
+                    maximum = max(1, feeds + counts["entries"])
+                percent = float(done) / maximum
                 testimated = (time() - tstart) * (1.001 - percent) / max(0.01, percent)
                 size = int(40 * percent)
                 bar = "=" * size + " " * (40 - size)
-                throbber = "-\\|/"[tick % 4] if percent < 1 else "X"
+                throbber = "-\\|/"[tick % 4] if not finished.is_set() else "X"
                 sys.stdout.write("%c %3i%% [ %s ] (%i of %i, %i sec)\r" % \
-                        (throbber, 100 * percent, bar, maximum - remaining, maximum, testimated))
+                        (throbber, 100 * percent, bar, done, maximum, testimated))
                 tick += 1
-                if percent >= 1:
+                if finished.is_set():
                     print
                     return
                 sleep(0.10)
 
 
-        def __run_processes(target, inqueue, outqueue=None):
-            threads = max(1, (NUM_THREADS - 1))
-            for n in range(threads):
-                if outqueue:
-                    p = Process(target=target, args=(n, inqueue, outqueue))
-                else:
-                    p = Process(target=target, args=(n, inqueue))
-                p.daemon = True
-                p.start()
-            pp = Process(target=__progress, args=(-1, inqueue))
-            pp.daemon = True
-            pp.start()
-            inqueue.close()
-            inqueue.join()
+        def __start_threads(number, target, *args):
+            threads = []
+            for n in range(max(1, number)):
+                t = Thread(target=target, args=(n,) + args)
+                t.daemon = True
+                t.start()
+                threads.append(t)
+            return threads
 
 
-        art_queue = JoinableQueue()
-        feed_queue = JoinableQueue()
+        art_queue = Queue(maxsize=self.config["queue_size"])
+        feed_queue = Queue()
+        write_queue = Queue()
 
-        for feedurl in set(self.config["abos"] + [x["feedurl"] for x in self.database["subscriptions"]]):
+        for feedurl in feedurls or self.feeds():
             feed_queue.put(feedurl)
-        
-        print "Downloading %i feeds.." % feed_queue.qsize()
-        __run_processes(__feed_worker, feed_queue, art_queue)
+        feeds = feed_queue.qsize()
+
+        if verbose:
+            print "Downloading %i feeds and their articles.." % feeds
+            tp = Thread(target=__progress, args=(-1, feeds))
+            tp.daemon = True
+            tp.start()
+
+        # articles are fetched while the remaining feeds are still parsed
+        writer = __start_threads(1, __writer, write_queue)[0]
+        art_threads = __start_threads(self.config["workers"],
+                                      __art_worker, art_queue, write_queue)
+        feed_threads = __start_threads(min(self.config["workers"], feeds),
+                                       __feed_worker, feed_queue, art_queue)
+        feed_queue.join()
+        for t in feed_threads:
+            t.join()
+        for t in art_threads:
+            art_queue.put(None)
+        for t in art_threads:
+            t.join()
+        write_queue.put(None)
+        writer.join()
+        if own_parser:
+            parser.close()
 
-        print "Downloading %i articles.." % art_queue.qsize()
-        __run_processes(__art_worker, art_queue)
+        finished.set()
+        counts["archived"] = self.expire()
+        self.rebase_ranking()
+        if verbose:
+            tp.join()
+            print "Folded %i duplicate entries." % counts["duplicates"]
+            print "Archived %i expired articles." % counts["archived"]
+            print "Done."
+        self.report(tstart, counts)
+        return outcomes
 
-        print "Done."
+    def report(self, tstart, counts):
+        """Add the metrics of a run to the totals and write its summary."""
+        series = METRICS.drain()
+        self.database["metrics"].add(series)
+        summary = summarize(series)
+        summary.update(counts)
+        summary["started"] = tstart
+        summary["seconds"] = time() - tstart
+        if self.config["run_summary"]:
+            with open(self.config["run_summary"], "w") as f:
+                json.dump(summary, f, indent=4, sort_keys=True)
 
 
-def initialize_database(config):
-    types = {"subscriptions": Set, "articles": Dict, "keyword_clicks": Counter}
-    db = {key: val() for key, val in types.items()}
+def backend(config):
+    """The storage backend chosen in the config, with its file if any."""
+    if config["storage"] == "sqlite":
+        return ("sqlite", config["sqlite"])
+    return ("redis", None)
+
+
+def connect(config):
+    """Client of the storage backend chosen in the config."""
+    if config["storage"] == "sqlite":
+        return SQLiteRedis(config["sqlite"])
+    return StrictRedis()
+
+
+def initialize_database(config, connection=None):
+    types = {"subscriptions": Dict,
+             "feed_cycles": Dict,
+             "feed_validators": Dict,
+             "image_sizes": Dict,
+             "articles": Articles,
+             "keyword_clicks": KeywordClicks,
+             "keyword_weights": KeywordWeights,
+             "ranking": Ranking,
+             "unread": SortedSetCounter,
+             "timeline": SortedSetCounter,
+             "keyword_index": KeywordIndex,
+             "article_ids": Links,
+             "feed_timelines": Timelines,
+             "archive_index": Dict,
+             "seen_links": SeenLinks,
+             "metrics": MetricTotals,
+             "data_version": Version,
+             "fingerprints": Fingerprints}
+    connection = connection or connect(config)
+    db = {key: val(redis=connection, key=KEY_PREFIX + key)
+          for key, val in types.items()}
     for piece, key in config["redis_keys"].items():
-        db[piece] = types[piece](key=key)
+        if piece not in types:
+            # a retired collection no longer used by this version
+            connection.delete(key)
+            del config["redis_keys"][piece]
+            continue
+        if types[piece] is Articles and connection.type(key) == "hash":
+            migrate_articles(Dict(redis=connection, key=key), db[piece])
+            continue
+        db[piece] = types[piece](redis=connection, key=key)
     return db
 
 
-def get_html(href):
-    if href[:-4] in [".pdf"]:
+def migrate_articles(legacy, articles):
+    """Move articles from a Dict of whole pickled articles into Articles."""
+    for link, article in legacy.scan_items():
+        articles[link] = article
+    legacy.clear()
+    return articles
+
+
+def get_html(href, fetcher=None):
+    """Html of a page, "" if it is no html or cannot be downloaded."""
+    if os.path.splitext(urlparse(href).path)[1].lower() in SKIPPED_EXTENSIONS:
         return ""
-    #print "loading %s" % href
+    fetcher = fetcher or Fetcher()
+    if "://" not in href:
+        href = "http://" + href
 
-    tries = 5
-    while tries:
+    for attempt in range(1 + RETRIES_PER_PAGE):
+        if attempt and not fetcher.retry():
+            break
         try:
-            try:
-                response = requests.get(href, timeout=1.0, verify=False)
-            except requests.exceptions.MissingSchema:
-                try:
-                    response = requests.get("http://"+href, timeout=1.0, verify=False)
-                except Exception, e:
-                    print e
-                    break
-            except requests.exceptions.InvalidSchema:
-                break
-            if response:
-                #print "loaded %s" % href
-                return response.content
+            with METRICS.timer("stage", stage="fetch"):
+                return fetcher.page(href)
         except (timeout,
                 requests.Timeout,
                 requests.ConnectionError,
-                requests.TooManyRedirects):
-            pass
-        finally:
-            tries -= 1
-
+                requests.packages.urllib3.exceptions.ProtocolError):
+            continue
+        except requests.RequestException:
+            break
+    METRICS.count("failures", kind="page", host=urlparse(href).hostname)
     return ""
 
 
+class LanguageGuesser(object):
+    """Guesses the language of a page by counting stop words in its text.
+
+    All stoplists of justext are loaded once into a single index from word
+    to the languages listing it.
+    """
+
+    def __init__(self, default="English", margin=LANGUAGE_MARGIN):
+        self.default = default
+        self.margin = margin
+        self.index = defaultdict(list)
+        for language in justext.get_stoplists():
+            for word in justext.get_stoplist(language):
+                self.index[word].append(language)
+
+    def tokens(self, html):
+        """Lower case words of the visible text, one after another."""
+        if not isinstance(html, unicode):
+            html = str(html).decode("utf-8", "ignore")
+        text = re_tags.sub(" ", re_invisible.sub(" ", html))
+        for match in re_tokens.finditer(text):
+            yield match.group().lower()
+
+    def guess(self, html):
+        hits = defaultdict(int)
+        for n, token in enumerate(self.tokens(html), 1):
+            for language in self.index.get(token, ()):
+                hits[language] += 1
+            if n % LANGUAGE_CHECK_EVERY == 0 and len(hits) > 1:
+                first, second = sorted(hits.values(), reverse=True)[:2]
+                if first - second >= self.margin:
+                    break
+        if not hits:
+            return self.default
+        return max(hits, key=hits.get)
+
+
+__language_guesser = []
+__language_guesser_lock = Lock()
+
+
 def guess_language(html):
-    hits = dict()
-    htmlset = set(str(html).split(" "))
-    for lang in justext.get_stoplists():
-        hits[lang] = len(set(justext.get_stoplist(lang)).intersection(htmlset))
-    return max(hits, key=hits.get)
+    with __language_guesser_lock:
+        if not __language_guesser:
+            __language_guesser.append(LanguageGuesser())
+    return __language_guesser[0].guess(html)
 
 
 def remove_boilerplate(html, language="English"):
     try:
         paragraphs = justext.justext(html, justext.get_stoplist(language))
-    except:
-        return html  # TODO alternative to justext
+    except Exception:
+        return extract_paragraphs(html)
     tag = lambda p: ("%s\n----\n" if p.is_heading else "%s\n\n") % p.text
     content = "".join([tag(p) for p in paragraphs if not p.is_boilerplate])
     return content
 
 
+def extract_paragraphs(html, min_length=40):
+    """Cheap stand-in for remove_boilerplate: the longer paragraphs."""
+    if not isinstance(html, unicode):
+        html = html.decode("utf-8", "replace")
+    unescape = HTMLParser().unescape
+    content = []
+    for tag, text in re_blocks.findall(re_invisible.sub("", html)):
+        text = re_spaces.sub(" ", unescape(re_tags.sub(" ", text))).strip()
+        if tag.lower() != "p":
+            content.append("%s\n----\n" % text)
+        elif len(text) >= min_length:
+            content.append("%s\n\n" % text)
+    return "".join(content)
+
+
+class ParseTimeout(Exception):
+    pass
+
+
+def __raise_timeout(signum, frame):
+    raise ParseTimeout()
+
+
+def limit_memory(memory):
+    """Let the calling process allocate at most *memory* more bytes."""
+    try:
+        with open("/proc/self/statm") as f:
+            used = int(f.read().split()[0]) * resource.getpagesize()
+    except (IOError, ValueError):
+        return
+    resource.setrlimit(resource.RLIMIT_AS, (used + memory, used + memory))
+
+
+def parse_page(page, seconds=None):
+    """Language and main text of a page.
+
+    Given seconds, the parse is interrupted after that time, and then or
+    when it runs out of memory the text is taken by extract_paragraphs.
+    """
+    if seconds:
+        signal.signal(signal.SIGALRM, __raise_timeout)
+        signal.setitimer(signal.ITIMER_REAL, seconds)
+    try:
+        with METRICS.timer("stage", stage="language"):
+            language = guess_language(page)
+        with METRICS.timer("stage", stage="boilerplate"):
+            return language, remove_boilerplate(page, language=language)
+    except ParseTimeout:
+        logging.info("Falling back to the cheap extractor")
+        METRICS.count("parse_fallbacks", reason="time")
+    except MemoryError:
+        logging.info("Falling back to the cheap extractor")
+        METRICS.count("parse_fallbacks", reason="memory")
+    finally:
+        if seconds:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+    return None, extract_paragraphs(page)
+
+
+def start_parser(memory):
+    """Prepare a Parser process before it takes pages."""
+    guess_language("")  # builds the stoplist index
+    limit_memory(memory)
+
+
+def parse_in_process(page, seconds):
+    """parse_page for a Parser process, with the metrics it recorded."""
+    return parse_page(page, seconds), METRICS.drain()
+
+
+def run_parser(address, authkey, memory):
+    """Parse the pages the Parser sends until it closes the connection."""
+    connection = Client(address, authkey=authkey)
+    start_parser(memory)
+    while True:
+        try:
+            page, seconds = connection.recv()
+        except (EOFError, IOError):
+            return
+        try:
+            parsed, series = parse_in_process(page, seconds)
+            connection.send((parsed, series, None))
+        except Exception, e:
+            connection.send((None, METRICS.drain(), repr(e)))
+
+
+def spawn_parsers(connection, parent, address, authkey, memory):
+    """Fork a parser process whenever the Parser asks, answering its pid.
+
+    Runs in a process forked before any thread was started, so the parsers
+    never inherit a lock held by a thread that is gone in them.
+    """
+    parent.close()  # or the Parser closing its end is never noticed
+    signal.signal(signal.SIGCHLD, signal.SIG_IGN)  # reaps the parsers
+    guess_language("")  # built once for all parsers
+    while True:
+        try:
+            connection.recv()
+        except (EOFError, IOError):
+            return
+        pid = os.fork()
+        if not pid:
+            try:
+                connection.close()
+                run_parser(address, authkey, memory)
+            finally:
+                os._exit(0)
+        connection.send(pid)
+
+
+class Parser(object):
+    """Processes parsing pages, sized to the cores.
+
+    Fetching threads hand their pages over, so parsing runs next to the
+    downloads and a bad page only costs its own budget. Processes stuck
+    where the alarm cannot reach them are killed and replaced. All of them
+    are forked by a spawner, itself forked when the Parser is made, so
+    make it before starting any thread.
+    """
+
+    def __init__(self, processes=NUM_THREADS, seconds=PARSE_SECONDS,
+                 memory=PARSE_MEMORY):
+        self.seconds = seconds
+        # the parser process stops itself after seconds, this is a backstop
+        self.backstop = 2 * seconds + 1
+        address = arbitrary_address("AF_UNIX")
+        authkey = os.urandom(20)
+        self.__spawner, connection = Pipe()
+        self.__process = Process(target=spawn_parsers,
+                                 args=(connection, self.__spawner, address,
+                                       authkey, memory))
+        self.__process.daemon = True
+        self.__process.start()
+        connection.close()
+        self.__listener = Listener(address, authkey=authkey)
+        self.__workers = dict()
+        self.__idle = Queue()
+        self.__lock = Lock()
+        for _ in range(max(1, processes)):
+            self.__idle.put(self.__start())
+
+    def __start(self):
+        """Pid of a new parser process and the connection to it."""
+        with self.__lock:
+            self.__spawner.send(None)
+            pid = self.__spawner.recv()
+            connection = self.__listener.accept()
+            self.__workers[pid] = connection
+        return pid, connection
+
+    def __replace(self, pid):
+        """Kill a parser process and start another one instead."""
+        with self.__lock:
+            connection = self.__workers.pop(pid, None)
+        if connection is not None:
+            connection.close()
+        try:
+            os.kill(pid, signal.SIGKILL)
+        except OSError:
+            pass  # gone already
+        return self.__start()
+
+    def parse(self, page):
+        """Language and main text of a page, see parse_page."""
+        worker = self.__idle.get()
+        pid, connection = worker
+        answer = None
+        try:
+            connection.send((page, self.seconds))
+            if connection.poll(self.backstop):
+                answer = connection.recv()
+            else:
+                logging.warn("Parser process stuck, falling back")
+                METRICS.count("parse_fallbacks", reason="stuck")
+        except (EOFError, IOError), e:
+            logging.warn("Parser process died: %s", e)
+            METRICS.count("parse_fallbacks", reason="error")
+        if answer is None:
+            try:
+                worker = self.__replace(pid)
+            finally:
+                self.__idle.put(worker)
+            return None, extract_paragraphs(page)
+        self.__idle.put(worker)
+        parsed, series, error = answer
+        METRICS.merge(series)
+        if error is None:
+            return parsed
+        logging.warn("Parser process failed: %s", error)
+        METRICS.count("parse_fallbacks", reason="error")
+        return None, extract_paragraphs(page)
+
+    def close(self):
+        with self.__lock:
+            workers, self.__workers = self.__workers, dict()
+            self.__spawner.close()
+            self.__listener.close()
+        for pid, connection in workers.items():
+            connection.close()
+            try:
+                os.kill(pid, signal.SIGKILL)
+            except OSError:
+                pass
+        self.__process.join()
+
+
 def find_keywords(title):
     return set([x.lower() for x in re_splitter.split(title) if x])
 
@@ -281,51 +2129,154 @@ def find_media(html):
     return template % findings[0] if findings else ""
 
 
-def find_picture(html):
+def image_size(imgurl, fetcher=None):
+    """Read the dimensions of an image from the beginning of its file.
+
+    Returns None if the image could not be downloaded and (0, 0) if it is
+    no image PIL understands.
+    """
+    fetcher = fetcher or Fetcher()
+    parser = ImageFile.Parser()
+
+    def probe(response):
+        read = 0
+        try:
+            for chunk in response.iter_content(IMAGE_PROBE_CHUNK):
+                read += len(chunk)
+                parser.feed(chunk)
+                if parser.image:
+                    return parser.image.size
+                if read >= IMAGE_PROBE_LIMIT:
+                    break
+        finally:
+            METRICS.count("fetched_bytes", read, kind="image",
+                          host=urlparse(imgurl).hostname)
+
+    try:
+        size = fetcher.stream(imgurl, probe)
+        if size:
+            return size
+    except (requests.RequestException,
+            requests.packages.urllib3.exceptions.LocationParseError):
+        # before IOError, which RequestException is a kind of
+        return None
+    except IOError:
+        pass
+    return (0, 0)
+
+
+def find_picture(html, fetcher=None, sizes=None):
+    """Find the biggest jpg of a page.
+
+    Sizes of images already seen are taken from and added to the *sizes*
+    mapping of url to (width, height).
+    """
     biggest = ""
     x, y = 0, 0
-    imagelist = re_images.findall(html)
-    for imgurl in imagelist:
+    fetcher = fetcher or Fetcher()
+    imagelist = list(OrderedDict.fromkeys(re_images.findall(html)))
+    if not imagelist:
+        return biggest
+
+    known = dict()
+    if sizes is not None:
+        known = {imgurl: size for imgurl, size in
+                 zip(imagelist, sizes.getmany(*imagelist)) if size}
+    unknown = [imgurl for imgurl in imagelist if imgurl not in known]
+    METRICS.count("cache_hits", len(known), cache="image_sizes")
+    METRICS.count("cache_misses", len(unknown), cache="image_sizes")
+    if unknown:
+        pool = ThreadPool(min(IMAGE_PROBES, len(unknown)))
         try:
-            try:
-                binary = StringIO(requests.get(imgurl,
-                                               timeout=1.0,
-                                               verify=False).content)
-                image = Image.open(binary)
-                if x * y < image.size[0] * image.size[1]:
-                    x, y = image.size
-                    biggest = imgurl
-            except IOError:
-                continue
-        except requests.packages.urllib3.exceptions.LocationParseError:
-            pass
+            probed = pool.map(lambda imgurl: image_size(imgurl, fetcher),
+                              unknown)
+        finally:
+            pool.close()
+        probed = {imgurl: size for imgurl, size in zip(unknown, probed)
+                  if size is not None}
+        if sizes is not None and probed:
+            sizes.update(probed)
+        known.update(probed)
+
+    for imgurl in imagelist:
+        width, height = known.get(imgurl, (0, 0))
+        if x * y < width * height:
+            x, y = width, height
+            biggest = imgurl
     return biggest
 
 
-def get_article(entry):
+def render_content(content):
+    """Render content as html, spanning first, middle and last sentences."""
+    original_content = markdown.markdown(escape(content, quote=True))
+    spaned_content = []
+    for paragraph in [p for p in re_paragraphs.findall(original_content) if p]:
+        sentences = [s for s in re_sentences.findall(paragraph) if s]
+        if not sentences:
+            continue
+        elif len(sentences) == 1:
+            spaned_content.append("<p><span>%s</span></p>" % sentences[0])
+        else:
+            spaned_content.append(
+                    "<p>%s</p>" % \
+                    ("<span>%s</span>"*3 % \
+                    (sentences[0], "".join(sentences[1:-1]), sentences[-1]))
+                    )
+    return " ".join(spaned_content)
+
+
+def article_id(link):
+    """Stable id of an article, derived from its link."""
+    if isinstance(link, unicode):
+        link = link.encode("utf-8")
+    return hashlib.sha1(link).hexdigest()[:16]
+
+
+def link_headline(title, keywords):
+    """Split a headline into words linking to their longest keyword.
+
+    Returns (word, template) pairs, with the article id left as %(id)s in
+    the templates. Words without a keyword are left out.
+    """
+    sorted_kwords = sorted(keywords, key=len, reverse=True)
+    link = lambda match: HEADLINE_LINK % (match.group(), match.group())
+    headline = []
+    for word in escape(title.lower(), quote=True).split(" "):
+        kwords = [kw for kw in sorted_kwords if kw.lower() in word.lower()]
+        if not kwords:
+            continue
+        headline.append((word, re.sub(r"(%s)" % re.escape(kwords[0]), link,
+                                      word.replace("%", "%%"), flags=re.I)))
+    return headline
+
+
+def get_article(entry, fetcher=None, sizes=None, parser=None):
     page = ""
     content = ""
     picture = ""
     media = ""
+    fetcher = fetcher or Fetcher()
 
-    page = get_html(entry.link)
-    language = guess_language(page)
+    page = get_html(entry.link, fetcher)
+    if page:
+        with METRICS.timer("stage", stage="parse"):
+            _, content = parser.parse(page) if parser else parse_page(page)
     try:
-        content = remove_boilerplate(page, language=language)
-    except justext.core.JustextError:
-        pass
-    try:
-        picture = find_picture(page)
+        with METRICS.timer("stage", stage="images"):
+            picture = find_picture(page, fetcher, sizes)
     except requests.exceptions.Timeout:
         pass
 
     media = find_media(page)
 
     keywords = find_keywords(entry.title)
-    article = {"link": entry.link,
+    article = {"id": article_id(entry.link),
+               "link": entry.link,
                "title": entry.title,
+               "headline": link_headline(entry.title, keywords),
                "release": time(),
                "content": content,
+               "rendered": (RENDER_VERSION, render_content(content)),
                "media": media,
                "image": picture,
                "keywords": keywords,
@@ -335,15 +2286,99 @@ def get_article(entry):
     return article
 
 
+def canonical_link(link):
+    """The link without scheme, www., tracking parameters and fragment."""
+    parts = urlsplit(link.strip())
+    host = parts.hostname or ""
+    if host.startswith("www."):
+        host = host[4:]
+    if parts.port and parts.port not in (80, 443):
+        host = "%s:%i" % (host, parts.port)
+    query = sorted((key, value) for key, value in
+                   parse_qsl(parts.query, keep_blank_values=True)
+                   if not re_tracking.match(key))
+    canonical = host + (parts.path.rstrip("/") or "")
+    if query:
+        canonical += "?" + "&".join("%s=%s" % pair for pair in query)
+    return canonical
+
+
+def fingerprint(text):
+    """Minhashes of the words in text, None if there are too few."""
+    words = set(word.lower() for word in re_splitter.split(text)
+                if len(word) > 2)
+    if len(words) < MINHASH_MIN_WORDS:
+        return None
+    hashes = [int(hashlib.md5(word.encode("utf-8")).hexdigest()[:15], 16)
+              for word in words]
+    return tuple(min((a * value + b) % MINHASH_PRIME for value in hashes)
+                 for a, b in MINHASH_SALTS)
+
+
+def similarity(fingerprint, other):
+    """Estimated share of words two fingerprinted texts have in common."""
+    same = sum(1 for a, b in zip(fingerprint, other) if a == b)
+    return float(same) / len(fingerprint)
+
+
+def same_headline(title, other):
+    """Whether two headlines share enough words to tell the same story."""
+    words, others = [set(word.lower() for word in re_splitter.split(text or "")
+                         if len(word) > 2) for text in (title, other)]
+    if not words or not others:
+        return False
+    shared = len(words & others)
+    return shared >= TITLE_OVERLAP * min(len(words), len(others))
+
+
+def feeds_of(article):
+    """Urls of the feeds an article was found in."""
+    return set([article.get("feed")] +
+               [feedurl for feedurl, _ in article.get("sources") or []])
+
+
+def entry_fingerprint(entry):
+    """Fingerprint of the title and summary of a feed entry."""
+    summary = re_tags.sub(" ", entry.get("summary") or "")
+    return fingerprint(u"%s %s" % (entry.get("title") or "", summary))
+
+
+def posting_interval(entries):
+    """Average seconds between the entries of a feed, None if unknown."""
+    stamps = [entry.get("published_parsed") or entry.get("updated_parsed")
+              for entry in entries]
+    stamps = sorted(calendar.timegm(stamp) for stamp in stamps if stamp)
+    if len(stamps) < 2 or stamps[-1] == stamps[0]:
+        return None
+    return float(stamps[-1] - stamps[0]) / (len(stamps) - 1)
+
+
 def display(articles):
     pprint.pprint(articles.values())
 
 
 if __name__ == "__main__":
-    logging.basicConfig()
+    APP = argparse.ArgumentParser(description="AnchorBot curation bot")
+    APP.add_argument("--daemon", "-d", default=False,
+                     help="keep polling each feed on its own schedule",
+                     action="store_const", const=True)
+    APP.add_argument("--storage", choices=["redis", "sqlite"], default=None,
+                     help="copy the database to this backend and use it "
+                          "from now on")
+    ARGS = APP.parse_args()
+
+    logging.basicConfig(level=logging.INFO if ARGS.daemon else logging.WARN)
     #logging.basicConfig(level=logging.DEBUG)
     for x in [HOME, HERE, CONFIGFILE, NUM_THREADS]:
         logging.debug("%s", x)
 
     with Bot() as b:
-        b.curate()
+        if ARGS.storage:
+            b.move_storage(ARGS.storage)
+        elif ARGS.daemon:
+            try:
+                b.watch()
+            except KeyboardInterrupt:
+                pass
+        else:
+            b.curate()
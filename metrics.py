@@ -0,0 +1,126 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+
+"""Counters and latency histograms in the Prometheus text format."""
+
+import re
+from time import time
+from threading import Lock
+from contextlib import contextmanager
+from collections import defaultdict
+
+re_le = re.compile(r',?le="([^"]+)"')
+
+PREFIX = "anchorbot_"
+# upper bounds of the latency buckets in seconds
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def series_of(name, **labels):
+    """Name of a time series, e.g. name{host="example.org"}."""
+    if not labels:
+        return PREFIX + name
+    return "%s%s{%s}" % (PREFIX, name, ",".join(
+        '%s="%s"' % (label, unicode(value).replace('"', "'"))
+        for label, value in sorted(labels.items())))
+
+
+def metric_of(series):
+    """Name of the metric a series belongs to, without labels and suffix."""
+    name = series.split("{")[0]
+    for suffix in ("_bucket", "_sum", "_count"):
+        if name.endswith("_seconds" + suffix):
+            return name[:-len(suffix)]
+    return name
+
+
+class Metrics(object):
+    """Thread-safe counters and histograms, kept as additive series.
+
+    Histogram buckets are cumulative, so the series of several processes
+    are aggregated by adding them up.
+    """
+
+    def __init__(self):
+        self.__series = defaultdict(float)
+        self.__lock = Lock()
+
+    def count(self, name, amount=1, **labels):
+        with self.__lock:
+            self.__series[series_of(name + "_total", **labels)] += amount
+
+    def observe(self, name, seconds, **labels):
+        """Add a latency to the histogram *name*_seconds."""
+        name += "_seconds"
+        with self.__lock:
+            for bound in BUCKETS:
+                if seconds <= bound:
+                    self.__series[series_of(name + "_bucket", le=bound,
+                                            **labels)] += 1
+            self.__series[series_of(name + "_bucket", le="+Inf",
+                                    **labels)] += 1
+            self.__series[series_of(name + "_sum", **labels)] += seconds
+            self.__series[series_of(name + "_count", **labels)] += 1
+
+    @contextmanager
+    def timer(self, name, **labels):
+        tstart = time()
+        try:
+            yield
+        finally:
+            self.observe(name, time() - tstart, **labels)
+
+    def merge(self, series):
+        with self.__lock:
+            for key, value in series.items():
+                self.__series[key] += value
+
+    def snapshot(self):
+        with self.__lock:
+            return dict(self.__series)
+
+    def drain(self):
+        """The series recorded since the last drain."""
+        with self.__lock:
+            series = dict(self.__series)
+            self.__series.clear()
+        return series
+
+
+def __order(series):
+    """Sort key grouping series by metric and buckets by their bound."""
+    bound = re_le.search(series)
+    return (metric_of(series), re_le.sub("", series),
+            float(bound.group(1)) if bound else 0)
+
+
+def render(series):
+    """Series in the Prometheus text exposition format."""
+    lines = []
+    metric = None
+    for key in sorted(series, key=__order):
+        if metric_of(key) != metric:
+            metric = metric_of(key)
+            kind = "histogram" if metric.endswith("_seconds") else "counter"
+            lines.append("# TYPE %s %s" % (metric, kind))
+        lines.append("%s %r" % (key, series[key]))
+    return "\n".join(lines) + "\n"
+
+
+def summarize(series):
+    """Totals and mean latencies of series, for a JSON run summary."""
+    summary = {"counters": {}, "latencies": {}}
+    for key, value in series.items():
+        name = key[len(PREFIX):]
+        if name.split("{")[0].endswith("_total"):
+            summary["counters"][name] = value
+        elif "_seconds_count" in name:
+            total = series[key.replace("_seconds_count", "_seconds_sum")]
+            summary["latencies"][name.replace("_seconds_count", "")] = {
+                "count": int(value),
+                "seconds": total,
+                "mean_ms": 1000 * total / value if value else 0}
+    return summary
+
+
+METRICS = Metrics()
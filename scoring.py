@@ -0,0 +1,77 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+
+"""Relevance of articles from time-decayed keyword clicks, with NumPy."""
+
+import numpy
+from time import time
+
+# a click counts half as much after this many seconds
+HALF_LIFE = 14 * 24 * 3600
+
+
+def decayed(weight, stamp, now=None, half_life=HALF_LIFE):
+    """A weight last set at time stamp, decayed until now."""
+    now = time() if now is None else now
+    return weight * 2 ** (-max(now - stamp, 0) / float(half_life))
+
+
+def forward(weight, stamp, epoch, half_life=HALF_LIFE):
+    """A weight set at time stamp, grown forward from an earlier epoch.
+
+    Sums of forward weights keep their order as time goes by, while
+    decaying all of them until now would scale them alike.
+    """
+    return weight * 2 ** ((stamp - epoch) / float(half_life))
+
+
+class Scorer(object):
+    """Scores many articles at once against the decayed keyword weights.
+
+    Keywords are the columns of a dense weight vector. The incidence of
+    articles and keywords is a sparse matrix in coordinate form, one
+    (row, column) pair per keyword of an article, so the relevance of all
+    rows is a single weighted bincount.
+    """
+
+    def __init__(self, weights, now=None, half_life=HALF_LIFE, epoch=None):
+        """Takes (keyword, (weight, time of the last click)) pairs.
+
+        Given an epoch, the weights are grown forward from it instead of
+        decayed until now, see forward().
+        """
+        weights = list(weights)
+        now = time() if now is None else now
+        self.keywords = [keyword for keyword, _ in weights]
+        self.column = {keyword: j for j, keyword in enumerate(self.keywords)}
+        values = numpy.array([value for _, value in weights],
+                             dtype=float).reshape(-1, 2)
+        if epoch is None:
+            exponents = -numpy.maximum(now - values[:, 1], 0) / half_life
+        else:
+            exponents = (values[:, 1] - epoch) / half_life
+        self.weights = values[:, 0] * numpy.exp2(exponents)
+
+    def __len__(self):
+        return len(self.keywords)
+
+    def ranked_keywords(self):
+        """(keyword, weight) pairs, heaviest first."""
+        order = numpy.argsort(-self.weights, kind="mergesort")
+        return [(self.keywords[j], float(self.weights[j])) for j in order]
+
+    def score(self, rows, columns, count):
+        """Relevance of count rows, given the coordinates of the matrix."""
+        return numpy.bincount(rows, weights=self.weights[columns],
+                              minlength=count)[:count]
+
+    def score_articles(self, articles):
+        """Relevance of articles by the keywords listed in each."""
+        pairs = [(i, self.column[keyword])
+                 for i, article in enumerate(articles)
+                 for keyword in set(article["keywords"])
+                 if keyword in self.column]
+        if not pairs:
+            return numpy.zeros(len(articles))
+        coordinates = numpy.array(pairs, dtype=int)
+        return self.score(coordinates[:, 0], coordinates[:, 1], len(articles))
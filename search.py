@@ -0,0 +1,103 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+
+"""Full-text index of article titles and contents in SQLite FTS5."""
+
+import re
+import sqlite3
+from contextlib import closing, contextmanager
+
+re_terms = re.compile(r"\w+", re.U)
+
+# wrap the matched terms in a snippet, so the caller can escape the rest
+MARK_START = u"\x02"
+MARK_END = u"\x03"
+# tokens of content around the matched terms in a snippet
+SNIPPET_TOKENS = 24
+# a match in the title counts this many times as much as one in the content
+TITLE_WEIGHT = 4.0
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS documents (
+    docid INTEGER PRIMARY KEY,
+    link TEXT UNIQUE NOT NULL,
+    id TEXT,
+    title TEXT,
+    release REAL);
+CREATE VIRTUAL TABLE IF NOT EXISTS texts USING fts5(
+    title, content, tokenize='unicode61 remove_diacritics 1');
+"""
+
+
+class SearchIndex(object):
+    """Titles and contents of articles, searchable by their words.
+
+    Search results carry everything needed to list them, so searching
+    does not touch redis. One process should write at a time, any number
+    may search meanwhile.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with self.__connect() as db:
+            db.execute("PRAGMA journal_mode=WAL")
+            db.executescript(SCHEMA)
+
+    @contextmanager
+    def __connect(self):
+        with closing(sqlite3.connect(self.path, timeout=30)) as db:
+            db.execute("PRAGMA synchronous=NORMAL")
+            with db:
+                yield db
+
+    def __len__(self):
+        with self.__connect() as db:
+            return db.execute("SELECT count(*) FROM documents").fetchone()[0]
+
+    def add(self, articles):
+        """Index articles, replacing earlier versions of the same links."""
+        with self.__connect() as db:
+            for article in articles:
+                row = db.execute("SELECT docid FROM documents WHERE link = ?",
+                                 (article["link"],)).fetchone()
+                fields = (article.get("id"), article["title"],
+                          article["release"], article["link"])
+                if row:
+                    docid = row[0]
+                    db.execute("DELETE FROM texts WHERE rowid = ?", (docid,))
+                    db.execute("UPDATE documents SET id = ?, title = ?, "
+                               "release = ? WHERE link = ?", fields)
+                else:
+                    docid = db.execute("INSERT INTO documents (id, title, "
+                                       "release, link) VALUES (?, ?, ?, ?)",
+                                       fields).lastrowid
+                db.execute("INSERT INTO texts (rowid, title, content) "
+                           "VALUES (?, ?, ?)",
+                           (docid, article["title"],
+                            article.get("content") or u""))
+
+    def search(self, query, offset=0, number=20):
+        """Total number of matches and one page of them, best first.
+
+        All words of the query have to match. Each match is a dict of the
+        id, link, title and release of its article, plus a snippet of
+        text with the matched words between MARK_START and MARK_END.
+        """
+        terms = re_terms.findall(query)
+        if not terms:
+            return 0, []
+        match = u" ".join(u'"%s"' % term for term in terms)
+        with self.__connect() as db:
+            total = db.execute("SELECT count(*) FROM texts WHERE texts MATCH ?",
+                               (match,)).fetchone()[0]
+            rows = db.execute(
+                "SELECT id, link, documents.title, release, "
+                "snippet(texts, -1, ?, ?, ?, ?) "
+                "FROM texts JOIN documents ON documents.docid = texts.rowid "
+                "WHERE texts MATCH ? ORDER BY bm25(texts, ?, 1.0) "
+                "LIMIT ? OFFSET ?",
+                (MARK_START, MARK_END, u"…", SNIPPET_TOKENS, match,
+                 TITLE_WEIGHT, number, offset)).fetchall()
+        return total, [{"id": row[0], "link": row[1], "title": row[2],
+                        "release": row[3], "snippet": row[4]}
+                       for row in rows]
@@ -2,6 +2,6 @@
 
 HERE=$(dirname $0)
 
-redis-server &
-while true; do $HERE/bot.py; sleep 3600; done &
+grep -qs '"storage": "sqlite"' ~/.config/anchorbot/config || redis-server &
+$HERE/bot.py --daemon &
 $HERE/web.py -d
@@ -0,0 +1,481 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+
+"""Embedded storage speaking the part of the redis API the bot uses."""
+
+import sqlite3
+import fnmatch
+import threading
+from functools import wraps
+from itertools import chain
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS hashes (
+    key BLOB, field BLOB, value BLOB,
+    PRIMARY KEY (key, field)) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS sets (
+    key BLOB, member BLOB,
+    PRIMARY KEY (key, member)) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS zsets (
+    key BLOB, member BLOB, score REAL,
+    PRIMARY KEY (key, member)) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS zsets_by_score ON zsets (key, score, member);
+"""
+TYPES = (("hashes", "hash"), ("sets", "set"), ("zsets", "zset"))
+
+
+def encode(value):
+    """Bytes of a key, field or value, the way redis-py sends them."""
+    if isinstance(value, bytes):
+        return value
+    if isinstance(value, unicode):
+        return value.encode("utf-8")
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+def blob(value):
+    return sqlite3.Binary(encode(value))
+
+
+def bound(value):
+    """Comparison and score of a bound of zrangebyscore, e.g. "(5"."""
+    if isinstance(value, basestring) and value.startswith("("):
+        return "<", float(value[1:])
+    return "<=", float(value)
+
+
+def atomic(command):
+    """Run a command of several statements in one transaction."""
+    @wraps(command)
+    def run(self, *args, **kwargs):
+        self.begin()
+        try:
+            result = command(self, *args, **kwargs)
+        except:
+            self.rollback()
+            raise
+        self.commit()
+        return result
+    return run
+
+
+class SQLiteRedis(object):
+    """A redis client storing its keys in a SQLite file instead.
+
+    Hashes, sets and sorted sets are rows of one table each, indexed by
+    key. Each thread has its own connection and every transactional pipeline
+    runs in one write transaction, so several threads and processes can
+    share a file. Other pipelines only batch their commands and never take
+    the write lock, so reading never waits for a writer.
+    Watched transactions hold the write lock from the first read to the
+    commit, so they never have to be retried.
+    """
+
+    def __init__(self, path, timeout=30):
+        self.path = path
+        self.timeout = timeout
+        self.__local = threading.local()
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.executescript(SCHEMA)
+
+    @property
+    def db(self):
+        db = getattr(self.__local, "db", None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=self.timeout,
+                                 isolation_level=None)
+            db.execute("PRAGMA synchronous=NORMAL")
+            self.__local.db = db
+            self.__local.depth = 0
+        return db
+
+    def begin(self):
+        """Enter a write transaction, nested ones join the outer one."""
+        db = self.db
+        if not self.__local.depth:
+            db.execute("BEGIN IMMEDIATE")
+        self.__local.depth += 1
+
+    def commit(self):
+        self.__local.depth -= 1
+        if not self.__local.depth:
+            self.db.execute("COMMIT")
+
+    def rollback(self):
+        self.__local.depth -= 1
+        if not self.__local.depth:
+            self.db.execute("ROLLBACK")
+
+    def __rows(self, sql, *args):
+        return self.db.execute(sql, args).fetchall()
+
+    def __value(self, sql, *args):
+        row = self.db.execute(sql, args).fetchone()
+        return row[0] if row else None
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        return Pipeline(self, transaction)
+
+    def transaction(self, func, *watches, **kwargs):
+        """Run func(pipe) and the commands it queued in one transaction."""
+        with self.pipeline() as pipe:
+            pipe.watch(*watches)
+            func(pipe)
+            return pipe.execute()
+
+    def info(self):
+        return {"redis_version": "0.0.0"}
+
+    # keys
+
+    def type(self, name):
+        for table, kind in TYPES:
+            if self.__value("SELECT 1 FROM %s WHERE key = ? LIMIT 1" % table,
+                            blob(name)):
+                return kind
+        return "none"
+
+    def exists(self, name):
+        return self.type(name) != "none"
+
+    @atomic
+    def delete(self, *names):
+        deleted = 0
+        for name in names:
+            if self.exists(name):
+                deleted += 1
+                for table, _ in TYPES:
+                    self.db.execute("DELETE FROM %s WHERE key = ?" % table,
+                                    (blob(name),))
+        return deleted
+
+    def scan_iter(self, match=None, count=None):
+        keys = set(bytes(key) for key, in chain(*[
+            self.__rows("SELECT DISTINCT key FROM %s" % table)
+            for table, _ in TYPES]))
+        for key in keys:
+            if match is None or fnmatch.fnmatchcase(key, match):
+                yield key
+
+    def keys(self, pattern="*"):
+        return list(self.scan_iter(pattern))
+
+    def flushdb(self):
+        for table, _ in TYPES:
+            self.db.execute("DELETE FROM %s" % table)
+        return True
+
+    # hashes
+
+    def hget(self, name, key):
+        value = self.__value("SELECT value FROM hashes WHERE key = ? AND "
+                             "field = ?", blob(name), blob(key))
+        return None if value is None else bytes(value)
+
+    def hmget(self, name, keys, *args):
+        keys = [keys] if isinstance(keys, basestring) else list(keys)
+        return [self.hget(name, key) for key in keys + list(args)]
+
+    def hgetall(self, name):
+        return {bytes(field): bytes(value) for field, value in self.__rows(
+            "SELECT field, value FROM hashes WHERE key = ?", blob(name))}
+
+    def hscan_iter(self, name, match=None, count=None):
+        for field, value in self.hgetall(name).iteritems():
+            if match is None or fnmatch.fnmatchcase(field, match):
+                yield field, value
+
+    def hkeys(self, name):
+        return [bytes(field) for field, in self.__rows(
+            "SELECT field FROM hashes WHERE key = ?", blob(name))]
+
+    def hlen(self, name):
+        return self.__value("SELECT count(*) FROM hashes WHERE key = ?",
+                            blob(name))
+
+    def hexists(self, name, key):
+        return self.hget(name, key) is not None
+
+    @atomic
+    def hset(self, name, key, value):
+        new = not self.hexists(name, key)
+        self.db.execute("INSERT OR REPLACE INTO hashes VALUES (?, ?, ?)",
+                        (blob(name), blob(key), blob(value)))
+        return int(new)
+
+    def hsetnx(self, name, key, value):
+        return self.db.execute("INSERT OR IGNORE INTO hashes VALUES (?, ?, ?)",
+                               (blob(name), blob(key), blob(value))).rowcount
+
+    def hmset(self, name, mapping):
+        self.db.executemany("INSERT OR REPLACE INTO hashes VALUES (?, ?, ?)",
+                            [(blob(name), blob(key), blob(value))
+                             for key, value in mapping.items()])
+        return True
+
+    def hdel(self, name, *keys):
+        return self.db.executemany(
+            "DELETE FROM hashes WHERE key = ? AND field = ?",
+            [(blob(name), blob(key)) for key in keys]).rowcount
+
+    @atomic
+    def hincrby(self, name, key, amount=1):
+        value = int(self.hget(name, key) or 0) + int(amount)
+        self.hset(name, key, value)
+        return value
+
+    @atomic
+    def hincrbyfloat(self, name, key, amount=1.0):
+        value = float(self.hget(name, key) or 0) + float(amount)
+        self.hset(name, key, value)
+        return value
+
+    # sets
+
+    def sadd(self, name, *values):
+        return self.db.executemany("INSERT OR IGNORE INTO sets VALUES (?, ?)",
+                                   [(blob(name), blob(value))
+                                    for value in values]).rowcount
+
+    def srem(self, name, *values):
+        return self.db.executemany(
+            "DELETE FROM sets WHERE key = ? AND member = ?",
+            [(blob(name), blob(value)) for value in values]).rowcount
+
+    def smembers(self, name):
+        return set(bytes(member) for member, in self.__rows(
+            "SELECT member FROM sets WHERE key = ?", blob(name)))
+
+    def sscan_iter(self, name, match=None, count=None):
+        for member in self.smembers(name):
+            if match is None or fnmatch.fnmatchcase(member, match):
+                yield member
+
+    def scard(self, name):
+        return self.__value("SELECT count(*) FROM sets WHERE key = ?",
+                            blob(name))
+
+    def sismember(self, name, value):
+        return bool(self.__value("SELECT 1 FROM sets WHERE key = ? AND "
+                                 "member = ?", blob(name), blob(value)))
+
+    # sorted sets
+
+    @atomic
+    def zadd(self, name, *args, **kwargs):
+        pairs = zip(args[1::2], args[::2]) + kwargs.items()
+        added = 0
+        for member, score in pairs:
+            if not self.db.execute("UPDATE zsets SET score = ? WHERE key = ? "
+                                   "AND member = ?", (float(score), blob(name),
+                                                      blob(member))).rowcount:
+                self.db.execute("INSERT INTO zsets VALUES (?, ?, ?)",
+                                (blob(name), blob(member), float(score)))
+                added += 1
+        return added
+
+    @atomic
+    def zincrby(self, name, value, amount=1):
+        score = (self.zscore(name, value) or 0) + float(amount)
+        self.zadd(name, score, value)
+        return score
+
+    def zscore(self, name, value):
+        return self.__value("SELECT score FROM zsets WHERE key = ? AND "
+                            "member = ?", blob(name), blob(value))
+
+    def zcard(self, name):
+        return self.__value("SELECT count(*) FROM zsets WHERE key = ?",
+                            blob(name))
+
+    def zrem(self, name, *values):
+        return self.db.executemany(
+            "DELETE FROM zsets WHERE key = ? AND member = ?",
+            [(blob(name), blob(value)) for value in values]).rowcount
+
+    def __by_rank(self, name, start, end, desc):
+        if start < 0 or end < 0:
+            size = self.zcard(name)
+            start = start + size if start < 0 else start
+            end = end + size if end < 0 else end
+        start = max(start, 0)
+        if end < start:
+            return []
+        order = "DESC" if desc else ""
+        return self.__rows("SELECT member, score FROM zsets WHERE key = ? "
+                           "ORDER BY score %s, member %s LIMIT ? OFFSET ?" %
+                           (order, order), blob(name), end - start + 1, start)
+
+    def __by_score(self, name, low, high, start, num, desc):
+        (low_op, low), (high_op, high) = bound(low), bound(high)
+        order = "DESC" if desc else ""
+        return self.__rows("SELECT member, score FROM zsets WHERE key = ? "
+                           "AND ? %s score AND score %s ? "
+                           "ORDER BY score %s, member %s LIMIT ? OFFSET ?" %
+                           (low_op, high_op, order, order), blob(name),
+                           low, high, -1 if num is None else num, start or 0)
+
+    @staticmethod
+    def __items(rows, withscores):
+        if withscores:
+            return [(bytes(member), score) for member, score in rows]
+        return [bytes(member) for member, _ in rows]
+
+    def zrange(self, name, start, end, desc=False, withscores=False,
+               score_cast_func=float):
+        return self.__items(self.__by_rank(name, start, end, desc), withscores)
+
+    def zrevrange(self, name, start, end, withscores=False,
+                  score_cast_func=float):
+        return self.__items(self.__by_rank(name, start, end, True), withscores)
+
+    def zrangebyscore(self, name, min, max, start=None, num=None,
+                      withscores=False, score_cast_func=float):
+        return self.__items(self.__by_score(name, min, max, start, num, False),
+                            withscores)
+
+    def zrevrangebyscore(self, name, max, min, start=None, num=None,
+                         withscores=False, score_cast_func=float):
+        return self.__items(self.__by_score(name, min, max, start, num, True),
+                            withscores)
+
+    def zcount(self, name, min, max):
+        return len(self.__by_score(name, min, max, None, None, False))
+
+    @atomic
+    def zremrangebyscore(self, name, min, max):
+        members = self.zrangebyscore(name, min, max)
+        return self.zrem(name, *members) if members else 0
+
+    @atomic
+    def zremrangebyrank(self, name, min, max):
+        members = self.zrange(name, min, max)
+        return self.zrem(name, *members) if members else 0
+
+    def zscan_iter(self, name, match=None, count=None,
+                   score_cast_func=float):
+        for member, score in self.zrange(name, 0, -1, withscores=True):
+            if match is None or fnmatch.fnmatchcase(member, match):
+                yield member, score
+
+    @atomic
+    def zinterstore(self, dest, keys, aggregate=None):
+        """Intersect sorted sets, or sets scoring 1, into dest."""
+        weights = keys if isinstance(keys, dict) else dict.fromkeys(keys, 1)
+        combine = {"MIN": min, "MAX": max}.get((aggregate or "").upper(),
+                                                lambda a, b: a + b)
+        scores = None
+        for key, weight in weights.items():
+            if self.type(key) == "set":
+                items = dict.fromkeys(self.smembers(key), weight * 1.0)
+            else:
+                items = {member: weight * score for member, score in
+                         self.zrange(key, 0, -1, withscores=True)}
+            if scores is None:
+                scores = items
+            else:
+                scores = {member: combine(score, items[member])
+                          for member, score in scores.items()
+                          if member in items}
+        self.delete(dest)
+        for member, score in (scores or {}).items():
+            self.zadd(dest, score, member)
+        return len(scores or {})
+
+
+class Pipeline(object):
+    """Queues commands of a SQLiteRedis and runs them in one transaction.
+
+    Like a redis-py pipeline, commands run right away between watch() and
+    multi(), so a transaction can read before it writes. Without
+    transaction the commands run one by one, outside of a write lock.
+    """
+
+    def __init__(self, client, transaction=True):
+        self.client = client
+        self.transaction = transaction
+        self.stack = []
+        self.began = False
+        self.watching = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.reset()
+
+    def __getattr__(self, name):
+        command = getattr(self.client, name)
+
+        def queue(*args, **kwargs):
+            if self.watching:
+                return command(*args, **kwargs)
+            self.stack.append((command, args, kwargs))
+            return self
+        return queue
+
+    def watch(self, *names):
+        if not self.began:
+            self.client.begin()
+            self.began = True
+        self.watching = True
+
+    def multi(self):
+        self.watching = False
+
+    def execute(self, raise_on_error=True):
+        stack, self.stack = self.stack, []
+        self.watching = False
+        if not self.began:
+            if not self.transaction:
+                return [command(*args, **kwargs)
+                        for command, args, kwargs in stack]
+            self.client.begin()
+        self.began = False
+        try:
+            results = [command(*args, **kwargs)
+                       for command, args, kwargs in stack]
+        except:
+            self.client.rollback()
+            raise
+        self.client.commit()
+        return results
+
+    def reset(self):
+        self.stack = []
+        self.watching = False
+        if self.began:
+            self.began = False
+            self.client.rollback()
+
+
+def copy_keys(source, target, match, batch=500):
+    """Copy the hashes, sets and sorted sets whose keys match a pattern.
+
+    Works between any two clients, redis or SQLiteRedis. Returns the
+    number of keys copied.
+    """
+    copied = 0
+    keys = list(source.scan_iter(match))
+    for start in range(0, len(keys), batch):
+        with target.pipeline() as pipe:
+            for key in keys[start:start + batch]:
+                kind = source.type(key)
+                if kind == "none":
+                    continue  # gone since the scan
+                pipe.delete(key)
+                if kind == "hash":
+                    pipe.hmset(key, source.hgetall(key))
+                elif kind == "set":
+                    pipe.sadd(key, *source.smembers(key))
+                elif kind == "zset":
+                    pipe.zadd(key, *chain(*[
+                        (score, member) for member, score in
+                        source.zrange(key, 0, -1, withscores=True)]))
+                else:
+                    raise ValueError("Cannot copy %s %s" % (kind, key))
+                copied += 1
+            pipe.execute()
+    return copied
@@ -0,0 +1,140 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+
+"""Curate a feed served from memory into fakeredis."""
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+import threading
+from BaseHTTPServer import BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn, TCPServer
+
+from fakeredis import FakeStrictRedis
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(
+    __file__))))
+
+import bot
+from bot import Bot
+
+ENTRIES = 60
+PAGE = ("<html><head><title>Story %(i)i</title></head><body><p>%(text)s</p>"
+        "</body></html>")
+TEXT = ("Story number %i tells how the council of the city met on a rainy "
+        "evening to argue about the budget, the roads and the river. ")
+
+
+class Site(object):
+    """A feed of ENTRIES stories and their pages on a local port."""
+
+    def __init__(self):
+        site = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body, ctype = site.get(self.path)
+                if body is None:
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                self.send_header("Content-Type", ctype)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        class Server(ThreadingMixIn, TCPServer):
+            allow_reuse_address = True
+            daemon_threads = True
+
+        self.server = Server(("127.0.0.1", 0), Handler)
+        self.url = "http://127.0.0.1:%i" % self.server.server_address[1]
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def get(self, path):
+        if path == "/feed.xml":
+            items = "".join(
+                "<item><title>Story %i about topic%i</title>"
+                "<link>%s/story%i.html</link><description>%s</description>"
+                "</item>" % (i, i, self.url, i, TEXT % i)
+                for i in range(ENTRIES))
+            return ('<?xml version="1.0"?><rss version="2.0"><channel>'
+                    '<title>Local</title>%s</channel></rss>' % items,
+                    "application/rss+xml")
+        if path.startswith("/story"):
+            i = int(path[len("/story"):-len(".html")])
+            return PAGE % {"i": i, "text": (TEXT % i) * 5}, "text/html"
+        return None, None
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class Curate(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.site = Site()
+        self.connection = FakeStrictRedis()
+        self.connection.flushdb()
+        configfile = os.path.join(self.directory, "config")
+        with open(configfile, "w") as f:
+            f.write('{"abos": ["%s/feed.xml"], "workers": 8, "parsers": 1}'
+                    % self.site.url)
+        self.bot = Bot(configfile, connection=self.connection)
+        self.batch = bot.WRITE_BATCH
+        bot.WRITE_BATCH = 5
+
+    def tearDown(self):
+        bot.WRITE_BATCH = self.batch
+        self.site.close()
+        self.connection.flushdb()
+        shutil.rmtree(self.directory)
+
+    def test_failed_batch_keeps_writer(self):
+        store = self.bot.store_articles
+        lost = []
+
+        def store_once(articles, *args, **kwargs):
+            if not lost and articles:
+                lost.extend(articles)
+                raise IOError("database is locked")
+            return store(articles, *args, **kwargs)
+
+        self.bot.store_articles = store_once
+        with self.bot:
+            self.bot.curate(verbose=False)
+            stored = len(self.bot.database["articles"])
+        self.assertTrue(lost)
+        self.assertEqual(stored, ENTRIES - len(lost))
+
+    def test_failed_batch_is_fetched_again(self):
+        store = self.bot.store_articles
+
+        def fail(articles, *args, **kwargs):
+            if articles:
+                raise IOError("database is locked")
+            return store(articles, *args, **kwargs)
+
+        self.bot.store_articles = fail
+        with self.bot:
+            self.bot.curate(verbose=False)
+            self.assertEqual(len(self.bot.database["articles"]), 0)
+            self.assertFalse(self.bot.database["feed_validators"])
+        self.bot.store_articles = store
+        with self.bot:
+            self.bot.curate(verbose=False)
+            self.assertEqual(len(self.bot.database["articles"]), ENTRIES)
+            self.assertTrue(self.bot.database["feed_validators"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,98 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+
+"""Probe image sizes from a local server and cache only the answered ones."""
+
+import os
+import sys
+import socket
+import unittest
+import threading
+from io import BytesIO
+from BaseHTTPServer import BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn, TCPServer
+
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(
+    __file__))))
+
+from bot import Fetcher, image_size, find_picture
+
+
+def jpeg(width, height):
+    data = BytesIO()
+    Image.new("RGB", (width, height)).save(data, "JPEG")
+    return data.getvalue()
+
+
+class Sizes(dict):
+    """The part of the image_sizes collection find_picture uses."""
+
+    def getmany(self, *keys):
+        return [self.get(key) for key in keys]
+
+
+class Images(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        files = {"/big.jpg": jpeg(640, 480), "/small.jpg": jpeg(10, 8),
+                 "/broken.jpg": "no image at all"}
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path not in files:
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                self.send_header("Content-Type", "image/jpeg")
+                self.end_headers()
+                self.wfile.write(files[self.path])
+
+            def log_message(self, *args):
+                pass
+
+        class Server(ThreadingMixIn, TCPServer):
+            allow_reuse_address = True
+            daemon_threads = True
+
+        cls.server = Server(("127.0.0.1", 0), Handler)
+        cls.url = "http://127.0.0.1:%i" % cls.server.server_address[1]
+        thread = threading.Thread(target=cls.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def closed_url(self):
+        sock = socket.socket()
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+        sock.close()
+        return "http://127.0.0.1:%i/gone.jpg" % port
+
+    def test_sizes(self):
+        fetcher = Fetcher()
+        self.assertEqual(image_size(self.url + "/big.jpg", fetcher),
+                         (640, 480))
+        self.assertEqual(image_size(self.url + "/broken.jpg", fetcher),
+                         (0, 0))
+
+    def test_failed_download_is_none(self):
+        self.assertIsNone(image_size(self.closed_url(), Fetcher()))
+
+    def test_failed_download_is_not_cached(self):
+        gone = self.closed_url()
+        html = '<img src="%s/small.jpg"><img src="%s">' % (self.url, gone)
+        sizes = Sizes()
+        self.assertEqual(find_picture(html, Fetcher(), sizes),
+                         self.url + "/small.jpg")
+        self.assertEqual(sizes, {self.url + "/small.jpg": (10, 8)})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,172 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+
+"""Run the same commands against fakeredis and SQLiteRedis and compare."""
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+from fakeredis import FakeStrictRedis
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(
+    __file__))))
+
+from storage import SQLiteRedis, copy_keys
+
+
+class SameAsRedis(unittest.TestCase):
+    """Each test calls play(client) on both and expects the same results."""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.redis = FakeStrictRedis()
+        self.redis.flushdb()
+        self.sqlite = SQLiteRedis(os.path.join(self.directory, "db"))
+
+    def tearDown(self):
+        self.redis.flushdb()
+        shutil.rmtree(self.directory)
+
+    def same(self, play):
+        expected = play(self.redis)
+        self.assertEqual(play(self.sqlite), expected)
+        return expected
+
+    def test_hashes(self):
+        def play(client):
+            client.hset("h", "a", "1")
+            client.hmset("h", {"b": "2", u"ü": "3"})
+            return [client.hget("h", "a"), client.hget("h", "missing"),
+                    client.hmget("h", "a", "b", "c"),
+                    client.hmget("h", ["b", "a"]),
+                    client.hmget("h", "a"),
+                    client.hsetnx("h", "a", "9"), client.hsetnx("h", "d", "4"),
+                    client.hincrby("h", "n", 5), client.hincrby("h", "n"),
+                    client.hdel("h", "b", "missing"), client.hlen("h"),
+                    client.hexists("h", "b"), sorted(client.hkeys("h")),
+                    client.hgetall("h"), client.type("h"),
+                    client.exists("h"), client.delete("h", "missing"),
+                    client.exists("h"), client.hgetall("h")]
+        self.same(play)
+
+    def test_sets(self):
+        def play(client):
+            return [client.sadd("s", "a", "b", "c"), client.sadd("s", "a"),
+                    client.srem("s", "b", "missing"), client.scard("s"),
+                    client.sismember("s", "a"), client.sismember("s", "b"),
+                    client.smembers("s"), client.smembers("missing"),
+                    client.type("s")]
+        self.same(play)
+
+    def test_ranges(self):
+        def play(client):
+            for score, member in enumerate("abcdefgh"):
+                client.zadd("z", score, member)
+            client.zincrby("z", "a", 2.5)
+            ranges = [(0, -1), (0, 0), (1, 3), (-3, -1), (-1, -1), (-100, 2),
+                      (2, 100), (5, 2), (-2, -5), (100, 200)]
+            return ([client.zrange("z", start, end) for start, end in ranges] +
+                    [client.zrevrange("z", start, end, withscores=True)
+                     for start, end in ranges] +
+                    [client.zrangebyscore("z", 1, 4),
+                     client.zrangebyscore("z", "(1", "(4", withscores=True),
+                     client.zrangebyscore("z", "-inf", "+inf", start=2,
+                                          num=3),
+                     client.zrevrangebyscore("z", "(7", 2),
+                     client.zrevrangebyscore("z", "+inf", "-inf", start=1,
+                                             num=2),
+                     client.zcount("z", "(2", 5), client.zscore("z", "a"),
+                     client.zscore("z", "missing"), client.zcard("z"),
+                     client.zrem("z", "b", "missing"),
+                     client.zremrangebyscore("z", "-inf", "(3"),
+                     client.zremrangebyrank("z", -2, -1),
+                     client.zrange("z", 0, -1, withscores=True),
+                     client.type("z")])
+        self.same(play)
+
+    def test_zinterstore_with_sets(self):
+        def play(client):
+            client.zadd("z", 1.5, "a", 2, "b", 3, "c")
+            client.sadd("s", "b", "c", "d")
+            # fakeredis does not return the size of dest, so compare dest
+            client.zinterstore("dest", ["z", "s"])
+            summed = client.zrange("dest", 0, -1, withscores=True)
+            client.zinterstore("dest", ["s", "z"], aggregate="MAX")
+            highest = client.zrange("dest", 0, -1, withscores=True)
+            client.zinterstore("dest", ["z", "missing"])
+            return [summed, highest, client.zrange("dest", 0, -1),
+                    client.exists("dest")]
+        self.same(play)
+
+    def test_pipelines(self):
+        def play(client):
+            client.hset("h", "a", "1")
+            with client.pipeline(transaction=False) as pipe:
+                pipe.hget("h", "a")
+                pipe.hmget("h", "a", "b")
+                pipe.smembers("missing")
+                reads = pipe.execute()
+            with client.pipeline() as pipe:
+                pipe.hset("h", "b", "2")
+                pipe.sadd("s", "x")
+                pipe.zadd("z", 1, "x")
+                pipe.zincrby("z", "x", 2)
+                writes = pipe.execute()
+            return [reads, writes, client.hgetall("h"), client.smembers("s"),
+                    client.zrange("z", 0, -1, withscores=True)]
+        self.same(play)
+
+    def test_nested_transactions(self):
+        def play(client):
+            client.zadd("z", 1, "a", 2, "b")
+
+            def inner(pipe):
+                score = pipe.zscore("z", "a")
+                pipe.multi()
+                pipe.zadd("inner", score + 10, "a")
+
+            def outer(pipe):
+                members = pipe.zrange("z", 0, -1)
+                client.zincrby("clicks", "b", 1)
+                with client.pipeline(transaction=False) as lookup:
+                    for member in members:
+                        lookup.zscore("z", member)
+                    scores = lookup.execute()
+                client.transaction(inner, "inner")
+                pipe.multi()
+                for member, score in zip(members, scores):
+                    pipe.hset("copy", member, repr(score))
+                pipe.sadd("done", "yes")
+
+            return [client.transaction(outer, "z"),
+                    client.zrange("clicks", 0, -1, withscores=True),
+                    client.zrange("inner", 0, -1, withscores=True),
+                    client.hgetall("copy"), client.smembers("done")]
+        self.same(play)
+
+    def test_copy_keys(self):
+        def play(client):
+            client.hset("k:h", "a", "1")
+            client.sadd("k:s", "a", "b")
+            client.zadd("k:z", 2, "a")
+            client.hset("other", "a", "1")
+            return client
+
+        def dump(client):
+            return sorted((key, client.type(key)) for key in client.keys())
+
+        play(self.redis)
+        self.assertEqual(copy_keys(self.redis, self.sqlite, "k:*"), 3)
+        self.assertEqual(dump(self.sqlite), [("k:h", "hash"), ("k:s", "set"),
+                                             ("k:z", "zset")])
+        self.assertEqual(self.sqlite.hgetall("k:h"), {"a": "1"})
+        self.assertEqual(self.sqlite.smembers("k:s"), set(["a", "b"]))
+        self.assertEqual(self.sqlite.zrange("k:z", 0, -1, withscores=True),
+                         [("a", 2.0)])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -3,31 +3,91 @@
 
 """News display server."""
 
-from re import compile as re_compile, sub as re_sub, IGNORECASE
+from re import compile as re_compile, escape as re_escape, IGNORECASE
 import sys
 #via http://stackoverflow.com/a/14919377
 reload(sys)
 sys.setdefaultencoding('utf-8')
 
 import time
+import logging
 import argparse
-import markdown
+from functools import wraps
+from threading import Lock
+from collections import OrderedDict
 
-from flask import Flask, render_template, url_for, escape
+from flask import Flask, render_template, url_for, escape, request, g, \
+    Response, make_response
 from flaskext.markdown import Markdown
 
-from bot import Bot
+from bot import Bot, link_headline
+from metrics import METRICS, render
+from search import MARK_START, MARK_END
 
 _HOST = "0.0.0.0"
 _PORT = 8000
 FLASK_APP = Flask(__name__)
 Markdown(FLASK_APP)
 
-HASHED = dict()
-DEHASHED = dict()
-
-RE_SENTENCES = re_compile(r"[\(]?.+?[\.!\?][\)]?(?!\S)")
-RE_PARAGRAPHS = re_compile(r"(?<=<p>)[^<]+(?=</p>)")
+BOT = Bot()
+
+RE_TEXT = re_compile(r"(?<=>)[^<]+")
+
+# rendered pages by view and arguments, with the data version they show
+PAGES = OrderedDict()
+PAGES_LOCK = Lock()
+PAGE_CACHE_SIZE = 256
+# part of every ETag, so pages of an earlier server are not taken for current
+BOOT = "%x" % int(time.time())
+
+
+@FLASK_APP.before_request
+def __start_timer():
+    g.tstart = time.time()
+
+
+@FLASK_APP.after_request
+def __stop_timer(response):
+    route = request.endpoint or "unknown"
+    METRICS.observe("route", time.time() - g.tstart, route=route)
+    METRICS.count("responses", route=route, status=response.status_code)
+    return response
+
+
+def __cached(view):
+    """Serve the pages of a view from PAGES while the data version holds.
+
+    Conditional requests for the current version are answered with 304.
+    """
+    @wraps(view)
+    def cached(*args, **kwargs):
+        with BOT as b:
+            version = b.data_version()
+        etag = "%s-%i" % (BOOT, version)
+        if request.if_none_match.contains_weak(etag):
+            METRICS.count("cache_hits", cache="conditional")
+            response = Response(status=304)
+        else:
+            key = (view.__name__, args, tuple(sorted(kwargs.items())))
+            with PAGES_LOCK:
+                page = PAGES.pop(key, None)
+                if page:
+                    PAGES[key] = page  # most recently used last
+            if page and page[0] == version:
+                METRICS.count("cache_hits", cache="pages")
+                body = page[1]
+            else:
+                METRICS.count("cache_misses", cache="pages")
+                body = view(*args, **kwargs)
+                with PAGES_LOCK:
+                    PAGES[key] = (version, body)
+                    while len(PAGES) > PAGE_CACHE_SIZE:
+                        PAGES.popitem(last=False)
+            response = make_response(body)
+        response.set_etag(etag, weak=True)
+        response.headers["Cache-Control"] = "no-cache"
+        return response
+    return cached
 
 
 def __get_source_domain(uri):
@@ -36,68 +96,62 @@ def __get_source_domain(uri):
     return uri
 
 
+def __highlight(html, keyword):
+    """Emphasize a keyword in the text, not in the tags, of html."""
+    pattern = re_compile(r"(%s)" % re_escape(keyword), IGNORECASE)
+    emphasize = lambda text: pattern.sub(r"<strong>\1</strong>", text.group())
+    return RE_TEXT.sub(emphasize, html)
+
+
+def __link_headlines(b, articles):
+    """Link the headlines of articles and emphasize watched keywords.
+
+    Returns the watched keywords contained in each article.
+    """
+    watched_keywords = frozenset(b.database["keyword_clicks"].keys())
+    watched_keywords_art = dict()
+    for article in articles:
+        link = article["link"]
+
+        if not article["keywords"]:
+            b.update_article(link, read=True)
+            continue
+
+        headline = article.get("headline") or \
+            link_headline(article["title"], article["keywords"])
+        contained_watched_keywords = watched_keywords & set(article["keywords"])
+        watched_keywords_art[link] = contained_watched_keywords
+        ids = {"id": article["id"]}
+        linked_headline = [
+                ("<i>%s</i>" if word in contained_watched_keywords else "%s") %
+                (template % ids) for word, template in headline]
+        if not linked_headline:
+            continue
+        article["linked_headline"] = " ".join(linked_headline)
+    return watched_keywords_art
+
+
 @FLASK_APP.route("/table")
+@__cached
 def table(offset=0, number=12, since=259200, keyword=None):
     """Table arrangement of unread articles."""
-    global HASHED, DEHASHED
     offset = int(offset)
     number = int(number)
     back_then = int(since)
 
-    HASHED = dict()
-    DEHASHED = dict()
-
-    watched_keywords_art = dict()
-
-    with Bot() as b:
+    with BOT as b:
         articles = b.hot_articles(offset, number, since, keyword)
-        watched_keywords = frozenset(b.database["keyword_clicks"].keys())
-        for article in articles:
-            link = article["link"]
-
-            if not article["keywords"]:
-                b.update_article(link, read=True)
-                continue
-
-            # generate and remember hash values
-            HASHED[link] = hash(link)
-            DEHASHED[hash(link)] = link
-
-            # split headline into links
-            split_headline = unicode(escape(article["title"].lower())).split(" ")
-            sorted_kwords = sorted(article["keywords"], key=len, reverse=True)
-            linked_headline = []
-            contained_watched_keywords = watched_keywords & set(sorted_kwords)
-            watched_keywords_art[article["link"]] = contained_watched_keywords
-            for word in split_headline:
-                kwords = [kw for kw in sorted_kwords if kw.lower() in word.lower()]
-                if not kwords:
-                    continue
-
-                template = r"""<a href="/read/%s/because/of/\1" target="_blank">\1</a>"""
-                if word in contained_watched_keywords:
-                    template = "<i>%s</i>" % template
-
-                linked_headline.append(
-                        re_sub(r"(%s)" % kwords[0],
-                               template % HASHED[link],
-                               word,
-                               flags=IGNORECASE))
-            if not linked_headline:
-                continue
-            article["linked_headline"] = " ".join(linked_headline)
-
-        [int(k) for k in HASHED.values()]
+        watched_keywords_art = __link_headlines(b, articles)
 
         # prepare data sets for gallery
-        scores = {a["link"]: b.relevance_of_article(a) for a in articles}
-        scores["all"] = sum([b.relevance_of_article(x) for x in articles])
+        relevances = b.relevances_of_articles(articles)
+        scores = {a["link"]: r for a, r in zip(articles, relevances)}
+        scores["all"] = sum(relevances)
         content = render_template("table.html",
                                   style=url_for("static", filename="default.css"),
                                   articles=articles,
                                   new_offset=offset + 1,
                                   wka=watched_keywords_art,
-                                  hashed=HASHED,
                                   scores=scores)
         return content
 
@@ -107,86 +161,44 @@ def table(offset=0, number=12, since=259200, keyword=None):
 @FLASK_APP.route("/gallery")
 @FLASK_APP.route("/gallery/keyword/<keyword>")
 @FLASK_APP.route("/gallery/offset/<offset>")
+@__cached
 def gallery(offset=0, number=12, since=259200, keyword=None):
     """Arrangement of unread articles."""
-    global HASHED, DEHASHED
     offset = int(offset)
     number = int(number)
     back_then = int(since)
 
-    HASHED = dict()
-    DEHASHED = dict()
-
-    with Bot() as b:
+    with BOT as b:
         articles = b.hot_articles(offset, number, since, keyword)
-        watched_keywords = frozenset(b.database["keyword_clicks"].keys())
-        for article in articles:
-            link = article["link"]
-
-            if not article["keywords"]:
-                b.update_article(link, read=True)
-                continue
-
-            # generate and remember hash values
-            HASHED[link] = hash(link)
-            DEHASHED[hash(link)] = link
-
-            # split headline into links
-            split_headline = unicode(escape(article["title"].lower())).split(" ")
-            sorted_kwords = sorted(article["keywords"], key=len, reverse=True)
-            linked_headline = []
-            contained_watched_keywords = watched_keywords & set(sorted_kwords)
-            for word in split_headline:
-                kwords = [kw for kw in sorted_kwords if kw.lower() in word.lower()]
-                if not kwords:
-                    continue
-
-                template = r"""<a href="/read/%s/because/of/\1" target="_blank">\1</a>"""
-                if word in contained_watched_keywords:
-                    template = "<i>%s</i>" % template
-
-                linked_headline.append(
-                        re_sub(r"(%s)" % kwords[0],
-                               template % HASHED[link],
-                               word,
-                               flags=IGNORECASE))
-            if not linked_headline:
-                continue
-            article["linked_headline"] = " ".join(linked_headline)
-
-        [int(k) for k in HASHED.values()]
+        __link_headlines(b, articles)
 
         # prepare data sets for gallery
-        scores = {a["link"]: b.relevance_of_article(a) for a in articles}
-        scores["all"] = sum([b.relevance_of_article(x) for x in articles])
+        relevances = b.relevances_of_articles(articles)
+        scores = {a["link"]: r for a, r in zip(articles, relevances)}
+        scores["all"] = sum(relevances)
         content = render_template("gallery.html",
                                   style=url_for("static", filename="default.css"),
                                   articles=articles,
                                   new_offset=offset + 1,
-                                  hashed=HASHED,
                                   scores=scores)
         return content
 
 
-@FLASK_APP.route("/mark/as/read/<hashed>")
-def mark_as_read(hashed):
-    global DEHASHED
-
-    with Bot() as b:
-        hashed = [int(h) for h in hashed.split("+")]
-        for h in hashed:
-            try:
-                link = DEHASHED[h]
-                if link:
-                    b.update_article(link, read=True)
-            except KeyError, e:
-                print e, "not in", DEHASHED
+@FLASK_APP.route("/mark/as/read/<ids>")
+def mark_as_read(ids):
+    with BOT as b:
+        for article_id in ids.split("+"):
+            link = b.link_of(article_id)
+            if link:
+                b.update_article(link, read=True)
+            else:
+                logging.warn("Cannot mark unknown article %s as read", article_id)
         return "OK"
 
 
-@FLASK_APP.route("/dismiss/<hashed>")
-def dismiss(hashed):
-    mark_as_read(hashed)
+@FLASK_APP.route("/dismiss/<ids>")
+def dismiss(ids):
+    mark_as_read(ids)
     return gallery()
 
 
@@ -203,8 +215,9 @@ def read_feed():
 
 @FLASK_APP.route("/like/keyword/by/id/<keyword>")
 def like_keyword(keyword):
-    with Bot() as b:
-        b.database["keyword_clicks"].update([keyword])
+    with BOT as b:
+        b.like_keyword(keyword)
+        return "OK"
 
 
 @FLASK_APP.route("/feeds")
@@ -221,12 +234,12 @@ def get_feeds():
 @FLASK_APP.route("/list/keys")
 @FLASK_APP.route("/list/keywords")
 @FLASK_APP.route("/list/keywords/offset/<offset>")
+@__cached
 def get_keywords(number=100, offset=0):
-    with Bot() as b:
-        keywords = b.database["keyword_clicks"].items()
-        keywords = sorted(keywords,
-                          key=b.relevance_of_keyword,
-                          reverse=True)[offset*number:(offset+1)*number]
+    offset = int(offset)
+    with BOT as b:
+        keywords = [(keyword, "%.1f" % relevance) for keyword, relevance in
+                    b.relevant_keywords()[offset*number:(offset+1)*number]]
         content = render_template("keywords.html",
                                   style=url_for("static", filename="default.css"),
                                   number=number,
@@ -238,11 +251,16 @@ def get_keywords(number=100, offset=0):
 @FLASK_APP.route("/key/<keyword>")
 @FLASK_APP.route("/key/<keyword>/<amount>")
 def read_keyword(keyword, amount=3):
-    content = render_template("read.html",
-                              style=url_for("static", filename="default.css"),
-                              articles=[],
-                              more_articles=[])
-    return content
+    with BOT as b:
+        more_articles = b.hot_articles(number=int(amount), since=0,
+                                       keyword=keyword)
+
+        content = render_template("read.html",
+                                  style=url_for("static", filename="default.css"),
+                                  articles=[],
+                                  more_articles=more_articles,
+                                  keyword=keyword)
+        return content
 
 
 @FLASK_APP.route("/media")
@@ -251,14 +269,10 @@ def read_keyword(keyword, amount=3):
 @FLASK_APP.route("/video/<amount>")
 def watch_media(amount=15):
     amount = int(amount)
-    with Bot() as b:
-        articles = list()
-        for article in b.hot_articles(number=None, since=0):
-            if amount <= 0:
-                break
-            if article["media"]:
-                articles.append(article)
-            amount -= 1
+    with BOT as b:
+        articles = [article for article in
+                    b.hot_articles(number=amount, since=0)
+                    if article["media"]]
 
         return render_template("media.html",
                                style=url_for("static", filename="default.css"),
@@ -266,70 +280,81 @@ def watch_media(amount=15):
                                more_articles=[])
 
 
-@FLASK_APP.route("/read/<hashed>")
-@FLASK_APP.route("/read/<hashed>/because/of/<keyword>")
-def read_article(hashed=None, keyword=None):
-    global HASHED
-
-    hashed = int(hashed)
+@FLASK_APP.route("/read/<article_id>")
+@FLASK_APP.route("/read/<article_id>/because/of/<keyword>")
+def read_article(article_id=None, keyword=None):
     if keyword:
         like_keyword(keyword)
 
+    with BOT as b:
+        link = b.link_of(article_id) if article_id else None
+        if link:
+            b.update_article(link, read=True)
+    return __read(link, keyword)
+
+
+@__cached
+def __read(link, keyword):
+    """Page of an article, already marked as read, and more about keyword."""
     articles = list()
     more_articles = list()
 
-    with Bot() as b:
-        if hashed:
-            link = None
-            try:
-                link = DEHASHED[hashed]
-            except KeyError:
-                for article in b.database["articles"]:
-                    if hashed == hash(article):
-                        link = article
-                        break
-            if link:
-                b.update_article(link, read=True)
+    with BOT as b:
+        if link:
+            article = b.load_article(link)
+            article['source'] = __get_source_domain(link)
+            article['also'] = [(other, __get_source_domain(other))
+                               for _, other in article.get('sources', [])
+                               if other != link]
+            article['date'] = time.ctime(article['release'])
+
+            if keyword:
+                article['spaned_content'] = __highlight(
+                        article['spaned_content'], keyword)
+            articles.append(article)
 
-                article = dict(b.database["articles"][link])
-                article['source'] = __get_source_domain(link)
-                article['date'] = time.ctime(article['release'])
-
-                original_content = markdown.markdown(escape(article['content']))
-                spaned_content = []
-                for paragraph in [p for p in RE_PARAGRAPHS.findall(original_content) if p]:
-                    sentences = [s for s in RE_SENTENCES.findall(paragraph) if s]
-                    if not sentences:
-                        continue
-                    elif len(sentences) == 1:
-                        spaned_content.append("<p><span>%s</span></p>" % sentences[0])
-                    else:
-                        spaned_content.append(
-                                "<p>%s</p>" % \
-                                ("<span>%s</span>"*3 % \
-                                (sentences[0], "".join(sentences[1:-2]), sentences[-1]))
-                                )
-                article['spaned_content'] = " ".join(spaned_content)
-                if keyword:
-                    article['spaned_content'] = re_sub(r"(%s)" % keyword,
-                            r"<strong>\1</strong>", article['spaned_content'],
-                            flags=IGNORECASE)
-                articles.append(article)
-
-        unread_with_keyword = lambda x: not x["read"] and keyword in x["keywords"]
-        more_articles = sorted([x for x in b.database["articles"].values()
-                                if unread_with_keyword(x)],
-                               key=b.relevance_of_article)
-        HASHED.update({hash(x["link"]): x["link"] for x in more_articles})
+        if keyword:
+            more_articles = b.hot_articles(number=None, since=0,
+                                           keyword=keyword)
 
         return render_template("read.html",
                                style=url_for("static", filename="default.css"),
                                articles=articles,
                                more_articles=more_articles,
-                               hashed=HASHED,
                                keyword=keyword)
 
 
+@FLASK_APP.route("/search")
+def search(number=20):
+    """Articles whose title or content contain all words of ?q=."""
+    query = request.args.get("q", u"")
+    offset = max(0, request.args.get("offset", 0, type=int))
+    with BOT as b:
+        total, results = b.search(query, offset * number, number)
+    for result in results:
+        result["source"] = __get_source_domain(result["link"])
+        result["date"] = time.ctime(result["release"])
+        result["snippet"] = unicode(escape(result["snippet"])) \
+            .replace(MARK_START, u"<strong>").replace(MARK_END, u"</strong>")
+    return render_template("search.html",
+                           style=url_for("static", filename="default.css"),
+                           query=query,
+                           total=total,
+                           results=results,
+                           offset=offset,
+                           more=total > (offset + 1) * number)
+
+
+@FLASK_APP.route("/metrics")
+def get_metrics():
+    """Metrics of this server and the totals of all curation runs."""
+    with BOT as b:
+        series = b.database["metrics"].series()
+    for name, value in METRICS.snapshot().items():
+        series[name] = series.get(name, 0) + value
+    return Response(render(series), mimetype="text/plain; version=0.0.4")
+
+
 def __main():
     """Main"""
     APP = argparse.ArgumentParser(description="AnchorBot server app")
@@ -345,6 +370,7 @@ def __main():
         FLASK_APP.run(host=ARGS.host,
                       port=ARGS.port,
                       debug=ARGS.debug,
+                      threaded=True,
                       use_reloader=False)
     except RuntimeError, e:
         print e